@@ -37,13 +37,16 @@ def send_slack(text):
     else:
         print("Skipping slack send")
 
-def bbox_start_change_cb(flight, flight_str):
+def bbox_start_change_cb(transition):
+    # format now, the flight will have moved on by the time the thread runs
+    flight_str = transition.to_str()
     dbg("*** bbox_start_change_cb "+flight_str)
-    t = threading.Thread(target=bbox_change_cb, args=[flight, flight_str])
+    t = threading.Thread(target=bbox_change_cb, args=[transition, flight_str])
     t.start()
 
-def bbox_change_cb(flight, flight_str):
-    local_time = datetime.datetime.fromtimestamp(flight.lastloc.now)
+def bbox_change_cb(transition, flight_str):
+    flight = transition.flight
+    local_time = datetime.datetime.fromtimestamp(transition.now)
     log(f"*** bbox_change_cb at {local_time}: {flight_str}")
 
     flight_id = flight.tail
@@ -51,7 +54,7 @@ def bbox_change_cb(flight, flight_str):
     if not flight_id:
         flight_id = flight_name
 
-    if "Nearby" in flight_str:
+    if transition.is_in("Nearby"):
         send_slack(flight_str)
 
 def api_read_loop(bbox_list, bbox_cb):
@@ -88,6 +91,9 @@ if __name__ == "__main__":
     parser.add_argument('--port', help="port to connect to")
     parser.add_argument('--api', action='store_true',
                         help="use web api instead of direct connect IP")
+    parser.add_argument('--bulk', help="read and apply socket input in batches", action="store_true")
+    parser.add_argument('--inplace', help="update flight locations in place, less allocation", action="store_true")
+    parser.add_argument('--columnar', help="keep a numpy table of flights for checkpoint work", action="store_true")
     args = parser.parse_args()
 
     if args.debug: set_dbg_level(2)
@@ -101,4 +107,5 @@ if __name__ == "__main__":
     else:
         listen = adsb_receiver.setup(args.ipaddr, args.port)
         adsb_receiver.flight_read_loop(listen, bboxes_list, None, None,
-            None, bbox_start_change_cb)
+            None, None, bulk=args.bulk, inplace=args.inplace,
+            columnar=args.columnar, transition_cb=bbox_start_change_cb)
@@ -15,12 +15,18 @@ import pytz
 import adsb_receiver
 from dbg import dbg, set_dbg_level, log
 from bboxes import Bboxes
+from dispatch import KeyedDispatcher
+from aircraft_cache import AircraftIdCache
 import appsheet_api
 
 TZ_CONVERT = 0 # -7  # UTC conversion
 
 as_instance = appsheet_api.Appsheet()
+aircraft_ids = AircraftIdCache(as_instance)    # see --aircraft-cache
 debug_stats = defaultdict(int)  # count by operation type sent to server
+# worker pool the receiver runs all callbacks on, keyed by flight so each
+# aircraft's events reach appsheet in order, see main
+dispatcher = None
 
 def lookup_or_create_aircraft(flight):
     """
@@ -35,28 +41,15 @@ def lookup_or_create_aircraft(flight):
     if flight.external_id:
         return flight.external_id
 
-    # id not cached locally
+    # id not cached on the flight, aircraft_ids has it if this tail's been seen before
     with flight.threadlock:
         if flight.external_id:  # recheck in case we were preempted
             return flight.external_id
-        aircraft_external_id = as_instance.aircraft_lookup(flight_id)
-        if not aircraft_external_id:
-            aircraft_external_id = as_instance.add_aircraft(flight_id)
-            log("LOOKUP added aircraft and now has aircraft_external_id %s" % aircraft_external_id)
-        else:
-            log("LOOKUP got cached aircraft_external_id %s" % aircraft_external_id)
-
-        flight.external_id = aircraft_external_id
+        flight.external_id = aircraft_ids.get(flight_id)
 
     return flight.external_id
 
-def bbox_start_change_cb(flight, flight_str, prev_flight_str):
-    dbg("*** bbox_start_change_cb "+flight_str)
-    t = threading.Thread(target=alt_bbox_change_cb, args=[flight, flight_str, 
-                                                          prev_flight_str])
-    t.start()
-
-def alt_bbox_change_cb(flight, current_str, old_str):
+def alt_bbox_change_cb(transition):
     """
     Different approach: try to catch the transition from ground to air and vice versa.
     This addresses the problem of aircraft that aren't reliably received, especially when 
@@ -70,9 +63,13 @@ def alt_bbox_change_cb(flight, current_str, old_str):
     about 20 popups, 18 looked good
 
     Scenics: check if we saw a local takeoff.  This will also count medevac goarounds tho
+
+    Runs on a dispatcher worker, so it can block on appsheet.
     """
+    dbg("*** alt_bbox_change_cb %s %s" % (transition.flight.flight_id, transition.new_names()))
     SAW_TAKEOFF = 'saw_takeoff'  # tracks scenic flights
 
+    flight = transition.flight
     flight_id = flight.tail
     flight_name = flight.flight_id.strip()
     if not flight_id:
@@ -81,32 +78,34 @@ def alt_bbox_change_cb(flight, current_str, old_str):
     op = None
     note_string = ''
 
-    if "Ground" in old_str and "Air" in current_str:
+    if transition.was_in("Ground") and transition.is_in("Air"):
         op = 'Takeoff'
         flight.flags[SAW_TAKEOFF] = True
 
-    if "Ground" in current_str and "Air" in old_str:
+    if transition.is_in("Ground") and transition.was_in("Air"):
         op = 'Landing'
         if SAW_TAKEOFF in flight.flags:
             note_string += ' Scenic'
 
-    if "Air" in current_str and not "Vicinity" in old_str and not 'Ground' in old_str:
+    if (transition.is_in("Air") and not transition.was_in("Vicinity") and
+        not transition.was_in("Ground")):
         op = 'Takeoff'
         note_string += " Popup"
         flight.flags[SAW_TAKEOFF] = True
         # XXX more handling for a/c that go silent for a while? > 60s expire?  saw a few
 
     if op:
-        flighttime = datetime.datetime.fromtimestamp(flight.lastloc.now +  7*60*60)
-        print(f"Got op {op} {flight_name} at {flighttime.strftime('%H:%M %d')}{note_string}")
+        flighttime = datetime.datetime.fromtimestamp(transition.now +  7*60*60)
+        print(f"Got op {op} {flight_name} at {flighttime.strftime('%H:%M %d')}{note_string} "
+              f"{int(flight.trend.fpm())} fpm")
         debug_stats[op] += 1
         aircraft_internal_id = lookup_or_create_aircraft(flight)
 
-        as_instance.add_op(aircraft_internal_id, flight.lastloc.now + TZ_CONVERT*60*60,
+        as_instance.add_op(aircraft_internal_id, transition.now + TZ_CONVERT*60*60,
             SAW_TAKEOFF in flight.flags, op, flight_name)
 
 
-def bbox_change_cb(flight, flight_str, old_bboxes):
+def bbox_change_cb(transition):
     """
     Called on all bbox changes, but only log to appsheet when LOGGED_BBOXES are entered.
     Also take note and log it later if NOTED_BBOX is seen.
@@ -116,17 +115,18 @@ def bbox_change_cb(flight, flight_str, old_bboxes):
     NOTED_BBOX = 'Pattern'
     FINAL_BBOX = 'Landing' # Must be in LOGGED_BBOXES.  When seen clears note about NOTED_BBOX.
 
-    local_time = datetime.datetime.fromtimestamp(flight.lastloc.now)
-    dbg(f"*** bbox_change_cb at {local_time}: {flight_str}")
+    flight = transition.flight
+    local_time = datetime.datetime.fromtimestamp(transition.now)
+    dbg(f"*** bbox_change_cb at {local_time}: {transition.new_names()}")
     debug_stats["bbox_change"] += 1
 
-    logged_bbox = next((b for b in LOGGED_BBOXES if b in flight_str), None)
+    logged_bbox = next((b for b in LOGGED_BBOXES if transition.is_in(b)), None)
     flight_id = flight.tail
     flight_name = flight.flight_id.strip()
     if not flight_id:
         flight_id = flight_name
 
-    if NOTED_BBOX in flight_str:
+    if transition.is_in(NOTED_BBOX):
         debug_stats[NOTED_BBOX] += 1
         flight.flags[NOTED_BBOX] = True
 
@@ -137,7 +137,7 @@ def bbox_change_cb(flight, flight_str, old_bboxes):
 
         aircraft_internal_id = lookup_or_create_aircraft(flight)
 
-        as_instance.add_op(aircraft_internal_id, flight.lastloc.now + 7*60*60, # XXX TZ
+        as_instance.add_op(aircraft_internal_id, transition.now + 7*60*60, # XXX TZ
                             noted, logged_bbox, flight_name)
 
     if logged_bbox is FINAL_BBOX:
@@ -156,6 +156,7 @@ class CPE:
     current_cpes = {}
     current_cpe_lock: threading.Lock = threading.Lock()
     CPE_GC_TIME = 60
+    CPA_TRUST_SECS = 10     # only trust closest approach predictions this far out
     gc_thread = None
 
     def __init__(self, flight1, flight2, latdist, altdist, create_time):
@@ -180,16 +181,19 @@ class CPE:
             self.min_latdist = latdist
             self.min_altdist = altdist
 
+    def update_min(self, latdist, altdist):
+        """Fold in a predicted closest approach, see cpa_cb()"""
+        if latdist <= self.min_latdist or altdist <= self.min_altdist:
+            self.min_latdist = latdist
+            self.min_altdist = altdist
+
     def key(self):
         key = "%s %s" % (self.flight1.flight_id.strip(),
             self.flight2.flight_id.strip())
         return key
 
-def cpe_start_cb(flight1, flight2, latdist, altdist):
-    t = threading.Thread(target=cpe_cb, args=[flight1, flight2, latdist, altdist])
-    t.start()
-
 def cpe_cb(flight1, flight2, latdist, altdist):
+    """Annotation callback, runs on a dispatcher worker like alt_bbox_change_cb"""
     if not CPE.gc_thread:
         CPE.gc_thread = threading.Thread(target=gc_loop)
         CPE.gc_thread.start()
@@ -219,6 +223,25 @@ def cpe_cb(flight1, flight2, latdist, altdist):
         cpe.id = as_instance.add_cpe(flight1_internal_id, flight2_internal_id,
             latdist, altdist, now, flight1.lastloc.lat, flight1.lastloc.lon)
 
+def cpa_cb(flight1, flight2, seconds, latdist, altdist):
+    """
+    Predicted closest approach from adsb_receiver.  For a CPE already
+    in progress, a prediction inside the next checkpoint interval is the
+    minimum separation the 10 second samples would miss.
+    """
+    if flight1.flight_id > flight2.flight_id: return    # called for both orders
+    cpe = CPE(flight1, flight2, latdist, altdist, flight1.lastloc.now)
+
+    with CPE.current_cpe_lock:
+        current = CPE.current_cpes.get(cpe.key())
+        if current and seconds <= CPE.CPA_TRUST_SECS:
+            dbg("CPE predicted minimum %s %.2f nm %d ft" % (cpe.key(), latdist, altdist))
+            current.update_min(latdist, altdist)
+            debug_stats["CPE predicted minimum"] += 1
+        elif not current:
+            log("Predicted CPE %s in %ds: %.2f nm %d ft" % (cpe.key(), seconds, latdist, altdist))
+            debug_stats["CPE predicted"] += 1
+
 def gc_loop():
     while True:
         time.sleep(10)
@@ -250,9 +273,8 @@ def cpe_gc():
 
 
 def test_cb():
-    print("starting thread")
-    t = threading.Thread(target=test_cb_body)
-    t.start()
+    print("queueing test")
+    dispatcher.submit("test", test_cb_body)
 
 def test_cb_body():
     log("TEST THREAD RUNNING.  Stats:")
@@ -269,6 +291,17 @@ def print_stats():
     for key, value in debug_stats.items():
         if value != 0:
             print(f"{key}: {value}")
+    # the checkpoint's Pipeline.report() starts the dispatcher's intervals
+    if dispatcher: dispatcher.report(reset=False)
+    for line in as_instance.latency_report(): print(line)
+    if as_instance.outbox: print(as_instance.outbox.report())
+    print(aircraft_ids.report())
+
+def exit_cb():
+    """Finish queued callbacks and batched appsheet writes, then print stats"""
+    if dispatcher: dispatcher.stop()
+    as_instance.close()
+    print_stats()
 
 if __name__ == "__main__":
     # No-GUI mode, see controller.py for GUI
@@ -280,7 +313,24 @@ if __name__ == "__main__":
     parser.add_argument('file', nargs='+', help="kml files to use")
     parser.add_argument('--ipaddr', help="IP address to connect to", required=True)
     parser.add_argument('--port', help="port to connect to", required=True)
+    parser.add_argument('--bulk', help="read and apply socket input in batches", action="store_true")
+    parser.add_argument('--columnar', help="keep a numpy table of flights for checkpoint work", action="store_true")
+    parser.add_argument('--workers', type=int, default=4,
+        help="threads making appsheet calls, each aircraft's calls are made in order")
+    parser.add_argument('--queue-size', type=int, default=1000,
+        help="most callbacks waiting for a worker")
+    parser.add_argument('--overload', choices=KeyedDispatcher.POLICIES, default="block",
+        help="when the queue is full, block ingest or drop the callback")
+    parser.add_argument('--batch-window', type=float, default=0,
+        help="seconds to collect appsheet rows for one multi-row call, 0 to send each on its own")
+    parser.add_argument('--batch-rows', type=int, default=20,
+        help="most rows per batched appsheet call")
+    parser.add_argument('--aircraft-cache', default="aircraft_ids.json",
+        help="json file keeping appsheet aircraft ids across restarts")
+    parser.add_argument('--outbox',
+        help="sqlite file to queue ops and CPEs in, sent in the background and kept across restarts")
     args = parser.parse_args()
+    if args.workers < 1: parser.error("--workers must be at least 1")
 
     if args.debug: set_dbg_level(2)
     else: set_dbg_level(1)
@@ -288,7 +338,14 @@ if __name__ == "__main__":
     for f in args.file:
         bboxes_list.append(Bboxes(f))
 
-    listen = adsb_receiver.setup(args.ipaddr, args.port, retry_conn=False, exit_cb=print_stats)
+    dispatcher = KeyedDispatcher(args.workers, args.queue_size, args.overload, "pusher")
+    if args.batch_window > 0: as_instance.enable_batching(args.batch_rows, args.batch_window)
+    if args.outbox: as_instance.enable_outbox(args.outbox)
+    aircraft_ids = AircraftIdCache(as_instance, args.aircraft_cache)
+    if appsheet_api.LOOKUP_AIRCRAFT: aircraft_ids.warm()
+    listen = adsb_receiver.setup(args.ipaddr, args.port, retry_conn=False, exit_cb=exit_cb)
 
     adsb_receiver.flight_read_loop(listen, bboxes_list, None, None,
-        cpe_start_cb, bbox_start_change_cb, test_cb=test_cb)
+        cpe_cb, None, test_cb=test_cb, bulk=args.bulk, cpa_cb=cpa_cb,
+        columnar=args.columnar, transition_cb=alt_bbox_change_cb,
+        dispatcher=dispatcher)
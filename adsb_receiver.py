@@ -1,25 +1,51 @@
 import socket
 import threading
-import json
 import signal
 import datetime
+import heapq
+import math
 import sys
 import time
 from typing import Dict
 
+import numpy as np
+import cpa
+import separation
 from test import test_insert, tests_enable, run_test
-from bboxes import Bboxes
+from bboxes import Bboxes, contains_many_layers
 from dbg import dbg, set_dbg_level, log
-from flight import Flight, Location
+from flight import Flight, Location, LocationDecoder, string_change_cb
+from flight_table import FlightTable, flight_columns
 
 class Flights:
-    """all Flight objects in the system, indexed by flight_id"""
-    flight_dict: Dict[str, Flight] = {}
-    lock: threading.Lock = threading.Lock()
+    """all Flight objects for one set of KML files, indexed by flight_id"""
+    flight_dict: Dict[str, Flight]
+    lock: threading.Lock
     EXPIRE_SECS: int = 180  # 3 minutes emperically needed to debounce poor-signal airplanes
-
-    def __init__(self, bboxes):
+    OVERFLIGHT_EXPIRE_SECS: int = 180  # same, for flights not in any bbox
+    VECTORIZE_MIN_BATCH: int = 16  # batches at least this big get bbox containment in one numpy pass
+    MIN_ALT_SEPARATION: int = 400 # 8000 # 400
+    MIN_ALT: int = 4000 # 100 # 4000
+    MIN_DISTANCE: float = .3 # 1   # .3 # nautical miles
+    MIN_FRESH: int = 10 # seconds, otherwise not evaluated
+    NM_PER_DEGREE: float = 59.  # a bit under the real minimum, for sizing distance check cells
+    EXACT_SEPARATION: bool = False  # re-check close pairs with the geodesic, see separation.py
+    CPA_HORIZON: int = 60   # seconds to extrapolate tracks for closest approach
+    CPA_RANGE: float = 5.   # nm, pairs further apart aren't extrapolated
+    CPA_ALT_RANGE: int = 2000   # feet, likewise
+    INPLACE_LOCATIONS: bool = False # copy updates into each flight's lastloc instead of keeping new Locations
+
+    def __init__(self, bboxes, columnar=False, dispatcher=None):
         self.bboxes = bboxes
+        self.flight_dict = {}
+        self.lock = threading.Lock()
+        self.dispatcher = dispatcher    # dispatch.KeyedDispatcher to run callbacks on, see emit()
+        # optional columnar copy of flight_dict for the checkpoint passes
+        self.table = FlightTable(len(bboxes)) if columnar else None
+        # lazy-deletion heap of (deadline, serial, flight), see expire_old()
+        self.expiry_heap = []
+        self.expiry_deadlines = {}  # flight_id: deadline of its live heap entry
+        self.expiry_serial = 0
 
     def add_location(self, loc: Location, new_flight_cb, update_flight_cb, bbox_change_cb):
         """
@@ -29,6 +55,9 @@ class Flights:
         loc: Location/flight info to update
         new_flight_cb(flight): called if loc is a new flight and just added to the database.
         update_flight_cb(flight): called when a flight position is updated.
+        bbox_change_cb(transition): called with a flight.BboxTransition when
+        the flight moves between bounding boxes.
+        Callbacks run after the lock is released, see emit().
         """
 
         flight_id = loc.flight
@@ -36,75 +65,304 @@ class Flights:
         # empty string for flight_id
         if not flight_id or flight_id == "N/A": return loc.now
 
+        events = []
         self.lock.acquire() # lock needed since testing can race
+        flight = self.update_flight(loc, new_flight_cb, update_flight_cb, bbox_change_cb,
+                                    events=events)
+        now = flight.lastloc.now
+        self.lock.release()
+        self.emit(events)
+        return now
 
+    def add_locations(self, batch, new_flight_cb, update_flight_cb, bbox_change_cb):
+        """
+        Same as add_location for a list of Locations, but only takes the lock
+        once for the whole batch.  Returns the timestamp of the last Location
+        in the batch, or None if the batch is empty.
+        """
+        # classify the whole batch against the bboxes up front, outside the lock
+        indices = [None] * len(batch)
+        if self.bboxes and len(batch) >= self.VECTORIZE_MIN_BATCH:
+            indices = contains_many_layers(self.bboxes,
+                [loc.lat for loc in batch], [loc.lon for loc in batch],
+                [loc.track for loc in batch], [loc.alt_baro for loc in batch]).tolist()
+
+        last_ts = None
+        events = []
+        with self.lock:
+            for loc, loc_indices in zip(batch, indices):
+                last_ts = loc.now
+                flight_id = loc.flight
+                if not flight_id or flight_id == "N/A": continue
+                self.update_flight(loc, new_flight_cb, update_flight_cb, bbox_change_cb,
+                                   loc_indices, events)
+        self.emit(events)
+        return last_ts
+
+    def update_flight(self, loc: Location, new_flight_cb, update_flight_cb, bbox_change_cb,
+                      indices=None, events=None):
+        """
+        Body of add_location, caller must hold self.lock.
+        events: list to queue the callbacks on for emit() once the lock is
+        released.  If not given they're emitted before returning.
+        """
+        emit_now = events is None
+        if emit_now: events = []
+        flight_id = loc.flight
         if flight_id in self.flight_dict:
             is_new_flight = False
             flight = self.flight_dict[flight_id]
-            flight.update_loc(loc)
+            flight.update_loc(loc, self.INPLACE_LOCATIONS)
         else:
             is_new_flight = True
-            flight = self.flight_dict[flight_id] = Flight(flight_id, loc.tail, loc, loc, self.bboxes)
-
-        flight.update_inside_bboxes(self.bboxes, loc, bbox_change_cb)
+            if self.INPLACE_LOCATIONS:
+                # lastloc gets overwritten, so it can't be firstloc or the caller's
+                flight = Flight(loc.flight, loc.tail, loc.copy(), loc.copy(), self.bboxes)
+            else:
+                flight = Flight(flight_id, loc.tail, loc, loc, self.bboxes)
+            self.flight_dict[flight.flight_id] = flight
+            if self.table is not None: self.table.add(flight)
+
+        transition = flight.update_inside_bboxes(self.bboxes, loc, None, indices)
+        if is_new_flight or transition: self.schedule_expiry(flight)
+        if self.table is not None: self.table.update(flight)
+        if transition and bbox_change_cb:
+            events.append((flight_id, bbox_change_cb, (transition,)))
 
         if is_new_flight:
-            if new_flight_cb: new_flight_cb(flight)
+            if new_flight_cb: events.append((flight_id, new_flight_cb, (flight,)))
             if flight.in_any_bbox(): log("New flight: " + flight.to_str())
         else:
             #if flight.in_any_bbox():
             #    logline = "Updating flight: " + flight.to_str()
             #    dbg(logline)
-            if update_flight_cb: update_flight_cb(flight)
+            if update_flight_cb: events.append((flight_id, update_flight_cb, (flight,)))
+        if emit_now: self.emit(events)
+        return flight
 
-        self.lock.release()
-        return flight.lastloc.now
+    def emit(self, events):
+        """
+        Run queued (flight_id, callback, args) events, in order.  With a
+        dispatcher they go to its workers keyed by flight_id, so each
+        flight's callbacks stay in order but none of them hold up ingest.
+        Callbacks see the flight as it is when they run, which may be later
+        than when the event was queued.
+        """
+        dispatcher = self.dispatcher
+        for key, callback, args in events:
+            if dispatcher: dispatcher.submit(key, callback, *args)
+            else: callback(*args)
+
+    def expire_secs(self, flight):
+        """How long flight can go unseen before it's expired"""
+        return self.EXPIRE_SECS if flight.in_any_bbox() else self.OVERFLIGHT_EXPIRE_SECS
+
+    def schedule_expiry(self, flight):
+        """
+        Make sure flight has a heap entry no later than its current deadline.
+        Needed when it's added or its expiry window may have shrunk, later
+        updates just push the deadline back, which expire_old() catches up on.
+        """
+        flight_id = flight.flight_id
+        deadline = (flight.lastloc.now or 0) + self.expire_secs(flight)
+        scheduled = self.expiry_deadlines.get(flight_id)
+        if scheduled is not None and scheduled <= deadline: return
+        self.expiry_deadlines[flight_id] = deadline
+        heapq.heappush(self.expiry_heap, (deadline, self.expiry_serial, flight))
+        self.expiry_serial += 1
 
     def expire_old(self, expire_cb, last_read_time):
+        """
+        Expire flights unseen for longer than their expire_secs().  Only
+        heap entries that have come due are looked at: entries replaced by
+        an earlier one or left behind by an expired flight are dropped, and
+        flights seen since their entry was pushed are rescheduled.
+        """
+        heap = self.expiry_heap
+        expired = []
         self.lock.acquire()
-        for f in list(self.flight_dict):
-            flight = self.flight_dict[f]
-            if last_read_time - flight.lastloc.now > self.EXPIRE_SECS:
-                if flight.in_any_bbox(): log("Expiring flight: %s" % f)
-                if expire_cb: expire_cb(flight)
-                del self.flight_dict[f]
+        while heap and heap[0][0] < last_read_time:
+            deadline, _, flight = heapq.heappop(heap)
+            f = flight.flight_id
+            if self.expiry_deadlines.get(f) != deadline or self.flight_dict.get(f) is not flight:
+                continue
+            del self.expiry_deadlines[f]
+            if last_read_time - (flight.lastloc.now or 0) > self.expire_secs(flight):
+                expired.append(flight)
+            else:
+                self.schedule_expiry(flight)
+
+        events = []
+        for flight in expired:
+            f = flight.flight_id
+            if flight.in_any_bbox(): log("Expiring flight: %s" % f)
+            if expire_cb: events.append((f, expire_cb, (flight,)))
+            del self.flight_dict[f]
+            if self.table is not None: self.table.remove(f)
 
         self.lock.release()
+        self.emit(events)
 
-    def check_distance(self, annotate_cb, last_read_time):
+    def reload_bboxes(self, bbox_change_cb, update_flight_cb):
         """
-        Check distance between all currently bbox'ed aircraft.
-        O(n^2), can be expensive, but altitude and bbox limits help..
+        Pick up edits to the KML files behind self.bboxes without losing
+        tracked flights.  Flights inside or near changed boxes are
+        re-evaluated and get the usual callbacks for any resulting bbox
+        change, the rest just have their box indices remapped.
         """
-        MIN_ALT_SEPARATION = 400 # 8000 # 400
-        MIN_ALT = 4000 # 100 # 4000
-        MIN_DISTANCE = .3 # 1   # .3 # nautical miles 
-        MIN_FRESH = 10 # seconds, otherwise not evaluated
-        flight_list = list(self.flight_dict.values())
-
-        for i, flight1 in enumerate(flight_list):
-            if not flight1.in_any_bbox(): continue
-            if last_read_time - flight1.lastloc.now > MIN_FRESH: continue
-            for j, flight2 in enumerate(flight_list[i+1:]):
-                if not flight2.in_any_bbox(): continue
-                if last_read_time - flight2.lastloc.now > MIN_FRESH: continue
-
-                loc1 = flight1.lastloc
-                loc2 = flight2.lastloc
-                if (loc1.alt_baro < MIN_ALT or loc2.alt_baro < MIN_ALT): continue
-                if abs(loc1.alt_baro - loc2.alt_baro) < MIN_ALT_SEPARATION:
-                    dist = loc1 - loc2
-
-                    if dist < MIN_DISTANCE:
-                        print("%s-%s inside minimum distance %.1f nm" %
-                            (flight1.flight_id, flight2.flight_id, dist))
-                        print("LAT, %f, %f, %d" % (flight1.lastloc.lat, flight1.lastloc.lon, last_read_time))
-                        if annotate_cb:
-                            annotate_cb(flight1, flight2, dist, abs(loc1.alt_baro - loc2.alt_baro))
-                            annotate_cb(flight2, flight1, dist, abs(loc1.alt_baro - loc2.alt_baro))
+        for layer, bboxes in enumerate(self.bboxes):
+            reload = bboxes.check_reload()
+            if not reload: continue
+
+            events = []
+            with self.lock:
+                affected = [(flight, flight.to_str()) for flight in self.flight_dict.values()
+                            if reload.affects(flight.inside_bboxes[layer],
+                                              flight.lastloc.lat, flight.lastloc.lon)]
+                bboxes.install(reload)
+                for flight in self.flight_dict.values():
+                    flight.inside_bboxes[layer] = reload.remap(flight.inside_bboxes[layer])
+
+                log("Re-evaluating %d of %d flights after %s reload" %
+                    (len(affected), len(self.flight_dict), bboxes.fn))
+                for flight, old_str in affected:
+                    transition = flight.update_inside_bboxes(self.bboxes, flight.lastloc, None,
+                                                             old_str=old_str)
+                    if transition and bbox_change_cb:
+                        events.append((flight.flight_id, bbox_change_cb, (transition,)))
+                    if update_flight_cb:
+                        events.append((flight.flight_id, update_flight_cb, (flight,)))
+                for flight in self.flight_dict.values():
+                    self.schedule_expiry(flight)
+                    if self.table is not None: self.table.update(flight)
+            self.emit(events)
+
+    def neighbor_pairs(self, columns, max_dist, max_alt):
+        """
+        Sorted (i, j), i < j, pairs of indices into columns (see
+        flight_table.py) for aircraft that may be within max_dist nm and
+        max_alt feet of each other.  Aircraft are bucketed into
+        lat/lon/altitude cells at least that big, so only aircraft in
+        neighboring cells need pairing.
+        """
+        # a degree of latitude is at least NM_PER_DEGREE nm, a degree of
+        # longitude shrinks with cos(lat) so size cells for the highest latitude
+        lats = columns["lat"]
+        lat_size = max_dist / self.NM_PER_DEGREE
+        max_lat = float(np.abs(lats).max()) + lat_size
+        lon_size = lat_size / math.cos(math.radians(min(max_lat, 89.)))
+        keys = zip(np.floor(lats / lat_size).astype(np.int64).tolist(),
+                   np.floor(columns["lon"] / lon_size).astype(np.int64).tolist(),
+                   np.floor(columns["alt_baro"] / max_alt).astype(np.int64).tolist())
+        cells = {}
+        for i, key in enumerate(keys):
+            cells.setdefault(key, []).append(i)
+
+        pairs = []
+        for (y, x, z), members in cells.items():
+            for dy in (-1, 0, 1):
+                for dx in (-1, 0, 1):
+                    for dz in (-1, 0, 1):
+                        neighbors = cells.get((y + dy, x + dx, z + dz))
+                        if not neighbors: continue
+                        pairs.extend((i, j) for i in members for j in neighbors if i < j)
+        pairs.sort()
+        return pairs
+
+    def distance_candidates(self, last_read_time):
+        """
+        Fresh, in-bbox flights at or above MIN_ALT in flight_dict order,
+        plus their columns, see flight_table.py.
+        """
+        if self.table is not None:
+            return self.table.candidates(last_read_time, self.MIN_FRESH, self.MIN_ALT)
+        flights = []
+        for flight in self.flight_dict.values():
+            loc = flight.lastloc
+            if not flight.in_any_bbox(): continue
+            if last_read_time - loc.now > self.MIN_FRESH: continue
+            if loc.alt_baro < self.MIN_ALT: continue
+            flights.append(flight)
+        return flights, flight_columns(flights)
+
+    def check_distance(self, annotate_cb, last_read_time, cpa_cb=None):
+        """
+        Check distance between all currently bbox'ed aircraft, see
+        neighbor_pairs(), all at once with separation.py's haversine.
+        Pairs are reported in the same order as a plain all-pairs loop over
+        flight_dict would.
+        cpa_cb: if given, also called with (flight1, flight2, seconds, nm, feet)
+        for pairs whose predicted closest approach within CPA_HORIZON
+        seconds is inside the minimums, see check_cpa().  Predictions go
+        out after the annotations, so a subscriber has already seen a pair
+        that just came inside the minimums when its prediction arrives.
+        """
+        flights, columns = self.distance_candidates(last_read_time)
+        if len(flights) < 2: return
+        self.check_close(annotate_cb, flights, columns, last_read_time)
+        if cpa_cb: self.check_cpa(cpa_cb, flights, columns, last_read_time)
+
+    def check_close(self, annotate_cb, flights, columns, last_read_time):
+        """Report pairs inside MIN_DISTANCE and MIN_ALT_SEPARATION now"""
+        pairs = self.neighbor_pairs(columns, self.MIN_DISTANCE, self.MIN_ALT_SEPARATION)
+        if not pairs: return
+
+        first, second = np.array(pairs, dtype=np.intp).T
+        dists, alt_seps = separation.pair_separations(
+            columns["lat"], columns["lon"], columns["alt_baro"], first, second)
+        limit = self.MIN_DISTANCE
+        if self.EXACT_SEPARATION: limit *= 1 + separation.MAX_RELATIVE_ERROR
+        close = np.flatnonzero((alt_seps < self.MIN_ALT_SEPARATION) & (dists < limit))
+
+        for k in close.tolist():
+            flight1 = flights[first[k]]
+            flight2 = flights[second[k]]
+            loc1 = flight1.lastloc
+            loc2 = flight2.lastloc
+            dist = float(dists[k])
+            if self.EXACT_SEPARATION:
+                dist = loc1 - loc2
+                if dist >= self.MIN_DISTANCE: continue
+
+            print("%s-%s inside minimum distance %.1f nm" %
+                (flight1.flight_id, flight2.flight_id, dist))
+            print("LAT, %f, %f, %d" % (flight1.lastloc.lat, flight1.lastloc.lon, last_read_time))
+            if annotate_cb:
+                alt_sep = abs(loc1.alt_baro - loc2.alt_baro)
+                self.emit(((flight1.flight_id, annotate_cb, (flight1, flight2, dist, alt_sep)),
+                           (flight2.flight_id, annotate_cb, (flight2, flight1, dist, alt_sep))))
+
+    def check_cpa(self, cpa_cb, flights, columns, last_read_time):
+        """
+        Extrapolate pairs within CPA_RANGE/CPA_ALT_RANGE of each other
+        along their tracks from last_read_time, each fix first brought
+        forward by its age, and report those predicted to come inside
+        MIN_DISTANCE and MIN_ALT_SEPARATION, including ones already there.
+        Catches conflicts before they happen, and the true minimum
+        separation between checkpoints.
+        """
+        pairs = self.neighbor_pairs(columns, self.CPA_RANGE, self.CPA_ALT_RANGE)
+        if not pairs: return
+        first, second = np.array(pairs, dtype=np.intp).T
+        t, dists, alt_seps = cpa.closest_approach(
+            columns["lat"], columns["lon"], columns["alt_baro"], columns["gs"],
+            columns["track"], columns["vrate"], first, second, self.CPA_HORIZON,
+            nows=columns["now"], when=last_read_time)
+        hits = np.flatnonzero((dists < self.MIN_DISTANCE) & (alt_seps < self.MIN_ALT_SEPARATION))
+
+        for k in hits.tolist():
+            flight1 = flights[first[k]]
+            flight2 = flights[second[k]]
+            dbg("%s-%s predicted closest approach %.2f nm %d ft in %.0fs" %
+                (flight1.flight_id, flight2.flight_id, dists[k], alt_seps[k], t[k]))
+            args = (float(t[k]), float(dists[k]), int(alt_seps[k]))
+            self.emit(((flight1.flight_id, cpa_cb, (flight1, flight2, *args)),
+                       (flight2.flight_id, cpa_cb, (flight2, flight1, *args))))
 
 
 class TCPConnection:
+    RECV_BUF_SIZE = 256*1024    # initial size of the bulk read buffer, grows if a line won't fit
+
     def __init__(self, host, port, retry, exit_cb):
         self.host = host
         self.port = port
@@ -112,6 +370,10 @@ class TCPConnection:
         self.retry = retry
         self.exit_cb = exit_cb
         self.f = None
+        self.buf = bytearray(self.RECV_BUF_SIZE)
+        self.buf_view = memoryview(self.buf)
+        self.buf_start = 0  # start of data not yet returned by read_lines
+        self.buf_end = 0    # end of valid data in buf
 
     def connect(self):
         try:
@@ -123,10 +385,71 @@ class TCPConnection:
             print('Connection Failed: '+str(e))
 
         self.f = self.sock.makefile()
+        self.buf_start = self.buf_end = 0
 
     def readline(self):
         return self.f.readline()
 
+    def read_lines(self):
+        """
+        Bulk read: recv_into the reusable buffer and return a list of
+        memoryviews, one per complete line.  Lines aren't copied out of the
+        buffer, so the views are only valid until the next call.
+        Don't mix with readline() on the same connection.
+        """
+        # move any partial line from the last read to the front of the buffer
+        partial = self.buf_end - self.buf_start
+        if self.buf_start:
+            self.buf[:partial] = self.buf[self.buf_start:self.buf_end]
+        if partial == len(self.buf):
+            # a single line filled the buffer, make room.  Allocate a new
+            # one rather than resizing since old views may still exist.
+            newbuf = bytearray(2 * len(self.buf))
+            newbuf[:partial] = self.buf[:partial]
+            self.buf = newbuf
+            self.buf_view = memoryview(newbuf)
+
+        n = self.sock.recv_into(self.buf_view[partial:])
+        if not n:
+            raise ConnectionError("connection closed by peer")
+        end = partial + n
+
+        lines = []
+        start = 0
+        while True:
+            nl = self.buf.find(b"\n", start, end)
+            if nl < 0: break
+            if nl > start:
+                lines.append(self.buf_view[start:nl])
+            start = nl + 1
+        self.buf_start = start
+        self.buf_end = end
+        return lines
+
+class IngestStats:
+    """Message and batch counters for the read loop, reported at each checkpoint."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start = time.time()
+        self.msgs = 0
+        self.batches = 0
+        self.max_batch = 0
+
+    def add_batch(self, n):
+        self.msgs += n
+        self.batches += 1
+        if n > self.max_batch: self.max_batch = n
+
+    def report(self):
+        elapsed = time.time() - self.start
+        if elapsed > 0 and self.batches:
+            print("Ingest: %d msgs in %.1fs, %.0f msgs/sec, %d batches, %.1f avg/%d max msgs per batch" %
+                (self.msgs, elapsed, self.msgs / elapsed, self.batches,
+                 self.msgs / self.batches, self.max_batch))
+        self.reset()
+
 def sigint_handler(signum, frame):
     sys.exit(1)
 
@@ -140,53 +463,182 @@ def setup(ipaddr, port, retry_conn=True, exit_cb=None):
     dbg("Setup done")
     return conn
 
-def flight_update_read(flights, listen, update_cb, bbox_change_cb):
+def handle_read_error(listen):
+    print(f"Socket input/parse error, reconnect plan = {listen.retry}")
+    if listen.retry:
+        time.sleep(2)
+        listen.connect()
+    else:
+        if listen.exit_cb:
+            listen.exit_cb()
+        sys.exit(1)
+
+class Pipeline:
+    """
+    One airport: a Flights for its own KML files, and the callbacks to call
+    for it.  Several Pipelines can share one readsb stream, see
+    pipeline_read_loop().
+    prefilter: skip positions outside the region around the KML files'
+    boxes, which can't be in any of them, unless the flight is already
+    tracked here.
+    """
+    def __init__(self, bbox_list, update_cb=None, expire_cb=None, annotate_cb=None,
+                 transition_cb=None, cpa_cb=None, columnar=False, dispatcher=None,
+                 prefilter=True, name=None):
+        self.flights = Flights(bbox_list, columnar, dispatcher)
+        self.update_cb = update_cb
+        self.expire_cb = expire_cb
+        self.annotate_cb = annotate_cb
+        self.transition_cb = transition_cb
+        self.cpa_cb = cpa_cb
+        self.dispatcher = dispatcher
+        self.prefilter = prefilter
+        self.name = name or ",".join(bboxes.fn for bboxes in bbox_list)
+        self.skipped = 0
+        self.update_region()
+
+    def update_region(self):
+        """(min lat, min lon, max lat, max lon) around all boxes, None if no boxes"""
+        extents = [bboxes.extent for bboxes in self.flights.bboxes if bboxes.extent]
+        self.region = None
+        if extents:
+            self.region = (min(e[1] for e in extents), min(e[0] for e in extents),
+                           max(e[3] for e in extents), max(e[2] for e in extents))
+
+    def wants(self, loc):
+        if not self.prefilter: return True
+        region = self.region
+        if (region and region[0] <= loc.lat <= region[2] and
+                region[1] <= loc.lon <= region[3]):
+            return True
+        # no lock needed, a stale answer just means one more or less update
+        if loc.flight in self.flights.flight_dict: return True
+        self.skipped += 1
+        return False
+
+    def add_location(self, loc):
+        if self.wants(loc):
+            self.flights.add_location(loc, self.update_cb, self.update_cb, self.transition_cb)
+
+    def add_locations(self, batch):
+        if self.prefilter: batch = [loc for loc in batch if self.wants(loc)]
+        self.flights.add_locations(batch, self.update_cb, self.update_cb, self.transition_cb)
+
+    def checkpoint(self, last_read_time):
+        flights = self.flights
+        flights.reload_bboxes(self.transition_cb, self.update_cb)
+        self.update_region()
+        flights.expire_old(self.expire_cb, last_read_time)
+        flights.check_distance(self.annotate_cb, last_read_time, self.cpa_cb)
+
+    def report(self):
+        if self.prefilter:
+            print("%s: %d flights, %d positions outside region skipped" %
+                  (self.name, len(self.flights.flight_dict), self.skipped))
+            self.skipped = 0
+        if self.dispatcher: self.dispatcher.report()
+
+def pipeline_update_read(pipelines, listen, stats=None, decoder=None):
+    if not decoder: decoder = LocationDecoder()
     try:
         line = listen.readline()
-        jsondict = json.loads(line)
+        loc_update = decoder.decode(line)
     except Exception:
-        print(f"Socket input/parse error, reconnect plan = {listen.retry}")
-        if listen.retry:
-            time.sleep(2)
-            listen.connect()
-        else:
-            if listen.exit_cb:
-                listen.exit_cb()
-            sys.exit(1)
+        handle_read_error(listen)
         return
-    #ppdbg(jsondict)
-
-    loc_update = Location.from_dict(jsondict)
-    last_ts = flights.add_location(loc_update, update_cb, update_cb, bbox_change_cb)
-    return last_ts
 
-def flight_read_loop(listen, bbox_list, update_cb, expire_cb, annotate_cb, bbox_change_cb, 
-                     test_cb=None):
+    if stats: stats.add_batch(1)
+    if not loc_update: return decoder.last_now
+    # XXX do we always convert from icao?  have seen some aircraft with
+    # empty string for flight_id
+    if loc_update.flight and loc_update.flight != "N/A":
+        for pipeline in pipelines:
+            pipeline.add_location(loc_update)
+    return loc_update.now
+
+def pipeline_update_read_bulk(pipelines, listen, stats=None, decoder=None):
+    """
+    Bulk version of pipeline_update_read: decode all complete lines
+    available on the socket and apply them to each pipeline under a single
+    Flights lock acquisition.
+    """
+    if not decoder: decoder = LocationDecoder()
+    try:
+        lines = listen.read_lines()
+    except Exception:
+        handle_read_error(listen)
+        return
 
+    batch = []
+    for line in lines:
+        try:
+            loc_update = decoder.decode(line)
+        except ValueError:
+            dbg("Skipping unparseable line: " + str(bytes(line)))
+            continue
+        if loc_update: batch.append(loc_update)
+
+    if stats: stats.add_batch(len(lines))
+    for pipeline in pipelines:
+        pipeline.add_locations(batch)
+    return decoder.last_now
+
+def pipeline_read_loop(listen, pipelines, test_cb=None, bulk=False, inplace=False):
+    """
+    Decode each readsb line once and feed it to every Pipeline that wants
+    it, then run each one's checkpoint work every CHECKPOINT_INTERVAL.
+    """
     CHECKPOINT_INTERVAL = 10 # seconds
     last_checkpoint = 0
     TEST_INTERVAL = 60*60 # run test every this many seconds
     last_test = 0
-    flights = Flights(bbox_list)
+    read_fn = pipeline_update_read_bulk if bulk else pipeline_update_read
+    stats = IngestStats()
+    if inplace and any(pipeline.dispatcher for pipeline in pipelines):
+        # callbacks on worker threads would read lastloc while it's being overwritten
+        raise ValueError("in-place locations can't be used with a callback dispatcher")
+    for pipeline in pipelines:
+        pipeline.flights.INPLACE_LOCATIONS = inplace
+    # bulk batches hold many Locations at once, so no scratch Location there
+    decoder = LocationDecoder(scratch=inplace and not bulk)
 
     while True:
-        last_read_time = flight_update_read(flights, listen, update_cb, bbox_change_cb)
+        last_read_time = read_fn(pipelines, listen, stats, decoder)
         if not last_checkpoint: last_checkpoint = last_read_time
 
         # XXX this skips during gaps when no aircraft are seen
         if last_read_time and last_read_time - last_checkpoint >= CHECKPOINT_INTERVAL:
             datestr = datetime.datetime.utcfromtimestamp(last_read_time).strftime('%Y-%m-%d %H:%M:%S')
             print("Checkpoint: %d %s" % (last_read_time, datestr))
+            stats.report()
 
-            flights.expire_old(expire_cb, last_read_time)
-            flights.check_distance(annotate_cb, last_read_time)
+            for pipeline in pipelines:
+                pipeline.report()
+                pipeline.checkpoint(last_read_time)
             last_checkpoint = last_read_time
 
         if test_cb and last_read_time and last_read_time - last_test >= TEST_INTERVAL:
             test_cb()
             last_test = last_read_time
 
-        run_test(lambda: test_insert(flights, update_cb))
+        run_test(lambda: test_insert(pipelines[0].flights, pipelines[0].update_cb))
+
+def flight_read_loop(listen, bbox_list, update_cb, expire_cb, annotate_cb, bbox_change_cb, 
+                     test_cb=None, bulk=False, cpa_cb=None, inplace=False, columnar=False,
+                     transition_cb=None, dispatcher=None):
+    """
+    pipeline_read_loop() for a single set of KML files, tracking every
+    flight in the feed.
+    bbox_change_cb(flight, flight_str, old_flight_str) is the old string
+    form of transition_cb(flight.BboxTransition), used if that's not given.
+    dispatcher: optional dispatch.KeyedDispatcher to run the callbacks on
+    instead of the read loop's thread.  Not with inplace, the workers would
+    read locations as they're overwritten.
+    """
+    if not transition_cb: transition_cb = string_change_cb(bbox_change_cb)
+    pipeline = Pipeline(bbox_list, update_cb, expire_cb, annotate_cb, transition_cb, cpa_cb,
+                        columnar, dispatcher, prefilter=False)
+    pipeline_read_loop(listen, [pipeline], test_cb, bulk, inplace)
 
 if __name__ == "__main__":
     # No-GUI mode, see controller.py for GUI
@@ -195,19 +647,29 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="match flights against kml bounding boxes")
     parser.add_argument("-d", "--debug", action="store_true")
     parser.add_argument('--test', help="add some test flights", action="store_true")
-    parser.add_argument('file', nargs='+', help="kml files to use")
+    parser.add_argument('file', nargs='*', help="kml files to use")
+    parser.add_argument('--airport', action='append', default=[],
+        help="comma separated kml files for another airport on the same feed, may be repeated")
     parser.add_argument('--ipaddr', help="IP address to connect to", required=True)
     parser.add_argument('--port', help="port to connect to", required=True)
+    parser.add_argument('--bulk', help="read and apply socket input in batches", action="store_true")
+    parser.add_argument('--inplace', help="update flight locations in place, less allocation", action="store_true")
+    parser.add_argument('--columnar', help="keep a numpy table of flights for checkpoint work", action="store_true")
     args = parser.parse_args()
+    airports = ([args.file] if args.file else []) + [a.split(",") for a in args.airport]
+    if not airports: parser.error("no kml files given")
 
     if args.debug: set_dbg_level(2)
     else: set_dbg_level(1)
     if args.test: tests_enable()
 
-    bboxes_list = []
-    for f in args.file:
-        bboxes_list.append(Bboxes(f))
-
     listen = setup(args.ipaddr, args.port)
 
-    flight_read_loop(listen, bboxes_list, None, None, None, None)
+    if len(airports) == 1:
+        bboxes_list = [Bboxes(f) for f in airports[0]]
+        flight_read_loop(listen, bboxes_list, None, None, None, None, bulk=args.bulk,
+                         inplace=args.inplace, columnar=args.columnar)
+    else:
+        pipelines = [Pipeline([Bboxes(f) for f in files], columnar=args.columnar)
+                     for files in airports]
+        pipeline_read_loop(listen, pipelines, bulk=args.bulk, inplace=args.inplace)
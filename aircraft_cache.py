@@ -0,0 +1,130 @@
+"""
+Process-wide cache of AppSheet aircraft Row IDs by tail number, so a new
+Flight for an aircraft already seen doesn't cost another Find.  Entries
+are trusted for ttl seconds, then looked up again, falling back to the
+old id if the lookup fails.  Optionally persisted to a JSON file and
+warmed from the whole aircraft table at startup.
+"""
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from appsheet_api import FAKE_KEY
+from dbg import dbg, log
+
+class AircraftIdCache:
+    TTL_SECS = 7*24*60*60
+
+    def __init__(self, appsheet, path=None, ttl=TTL_SECS):
+        self.appsheet = appsheet
+        self.path = path
+        self.ttl = ttl
+        self.ids = {}           # TAIL: (row id, time fetched)
+        self.inflight = {}      # TAIL: Future for a lookup in progress
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.hits = self.misses = self.stale = self.coalesced = 0
+        self.lookups = self.creates = self.failures = 0
+        if path: self.load()
+
+    @staticmethod
+    def key(tail):
+        return tail.strip().upper()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                ids = json.load(f)
+            self.ids = {tail: (row_id, fetched) for tail, (row_id, fetched) in ids.items()}
+            dbg("Loaded %d aircraft ids from %s" % (len(self.ids), self.path))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log("Couldn't read aircraft id cache %s: %s" % (self.path, str(e)))
+
+    def save(self):
+        if not self.path: return
+        with self.lock:
+            ids = dict(self.ids)
+        tmp = self.path + ".tmp"
+        with self.save_lock:
+            try:
+                with open(tmp, "w") as f:
+                    json.dump(ids, f)
+                os.replace(tmp, self.path)
+            except Exception as e:
+                log("Couldn't write aircraft id cache %s: %s" % (self.path, str(e)))
+
+    def warm(self):
+        """Fill the cache from the whole aircraft table in one call"""
+        rows = self.appsheet.get_all_entries("aircraft")
+        if not rows: return 0
+        now = time.time()
+        with self.lock:
+            for row in rows:
+                if row.get("Regno") and row.get("Row ID"):
+                    self.ids[self.key(row["Regno"])] = (row["Row ID"], now)
+        log("Aircraft id cache warmed with %d aircraft" % len(rows))
+        self.save()
+        return len(rows)
+
+    def get(self, tail):
+        """
+        Row ID for tail, looking it up or creating the aircraft if needed.
+        Concurrent calls for the same tail share one lookup.
+        """
+        key = self.key(tail)
+        with self.lock:
+            cached = self.ids.get(key)
+            if cached and time.time() - cached[1] < self.ttl:
+                self.hits += 1
+                return cached[0]
+            if cached: self.stale += 1
+            else: self.misses += 1
+            future = self.inflight.get(key)
+            if future:
+                self.coalesced += 1
+                leader = False
+            else:
+                future = self.inflight[key] = Future()
+                leader = True
+
+        if not leader: return future.result()
+        row_id = None
+        try:
+            row_id = self.fetch(tail, cached)
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            future.set_result(row_id)
+        return row_id
+
+    def fetch(self, tail, cached):
+        with self.lock: self.lookups += 1
+        row_id = self.appsheet.aircraft_lookup(tail)
+        if not row_id and cached:
+            # lookup failed, the old id is better than creating a duplicate
+            with self.lock: self.failures += 1
+            return cached[0]
+        if not row_id:
+            with self.lock: self.creates += 1
+            row_id = self.appsheet.add_aircraft(tail)
+            log("LOOKUP added aircraft and now has aircraft_external_id %s" % row_id)
+        else:
+            log("LOOKUP got cached aircraft_external_id %s" % row_id)
+        # placeholder ids from appsheet_api with sending turned off aren't worth keeping
+        if not row_id or row_id == FAKE_KEY: return row_id
+
+        with self.lock:
+            self.ids[self.key(tail)] = (row_id, time.time())
+        self.save()
+        return row_id
+
+    def report(self):
+        return ("Aircraft ids: %d cached, %d hits, %d misses, %d stale, %d coalesced, "
+                "%d lookups, %d created, %d failed lookups" %
+                (len(self.ids), self.hits, self.misses, self.stale, self.coalesced,
+                 self.lookups, self.creates, self.failures))
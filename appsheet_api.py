@@ -1,14 +1,21 @@
 #!/usr/bin/python3
 import copy
+from collections import defaultdict
 import json
 import datetime
 import argparse
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 import time
 import random
+import threading
+from concurrent.futures import Future
+from urllib.parse import unquote, urlsplit
 
 from config import Config
 from dbg import ppd, log, set_dbg_level, dbg
+import outbox
 
 BODY = {
 "Properties": {
@@ -26,11 +33,200 @@ SEND_OPS = False
 SEND_CPES = False
 FAKE_KEY = "XXXfake keyXXX"  # for testing purposes
 
-class Appsheet:
+class AppsheetError(Exception):
+    """A call AppSheet answered with something other than 200"""
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+def never_sent(error):
+    """Did error happen before the request went out, so it can't have been applied?"""
+    if isinstance(error, requests.ConnectTimeout): return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+def log_failure(what):
+    """Future done callback logging what's exception, if any"""
+    def done(future):
+        if future.exception(): log("%s raised exception: %s" % (what, future.exception()))
+    return done
+
+class RowBatcher:
+    """
+    Write-behind batching of single-row Add/Edit calls.  Rows for the same
+    url and action are collected and sent together in one call once
+    max_rows are waiting or the oldest has waited window seconds.  Each
+    submit() gets a Future for the row AppSheet returns for it.
+    send(url, body): Appsheet.sendop.
+    """
+    def __init__(self, send, max_rows=20, window=.5):
+        self.send = send
+        self.max_rows = max_rows
+        self.window = window
+        self.pending = {}       # (url, action): (deadline, rows, futures)
+        self.cond = threading.Condition()
+        self.closed = False
+        self.calls = 0
+        self.rows = 0
+        self.thread = threading.Thread(target=self.run, daemon=True, name="appsheet-batcher")
+        self.thread.start()
+
+    def submit(self, url, action, row):
+        future = Future()
+        with self.cond:
+            if self.closed: raise RuntimeError("RowBatcher is closed")
+            key = (url, action)
+            batch = self.pending.get(key)
+            if batch is None:
+                batch = self.pending[key] = (time.monotonic() + self.window, [], [])
+                self.cond.notify()
+            batch[1].append(row)
+            batch[2].append(future)
+            if len(batch[1]) >= self.max_rows: self.cond.notify()
+        return future
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.monotonic()
+                    due = [key for key, (deadline, rows, _) in self.pending.items()
+                           if self.closed or deadline <= now or len(rows) >= self.max_rows]
+                    if due or self.closed: break
+                    timeout = min((deadline for deadline, _, _ in self.pending.values()),
+                                  default=None)
+                    self.cond.wait(None if timeout is None else timeout - now)
+                if not due: return
+                batches = [(key, self.pending.pop(key)) for key in due]
+
+            for (url, action), (_, rows, futures) in batches:
+                for start in range(0, len(rows), self.max_rows):
+                    self.flush(url, action, rows[start:start + self.max_rows],
+                               futures[start:start + self.max_rows])
+
+    def flush(self, url, action, rows, futures):
+        body = copy.deepcopy(BODY)
+        body["Action"] = action
+        body["Rows"] = rows
+        dbg("RowBatcher %s %d rows to ...%s" % (action, len(rows), url[-20:]))
+        try:
+            ret = self.send(url, body)
+            returned = (ret.get("Rows") if isinstance(ret, dict) else None) or [None] * len(rows)
+            if len(returned) != len(rows):
+                raise Exception("%s sent %d rows, got back %d" % (action, len(rows), len(returned)))
+        except Exception as e:
+            for future in futures: future.set_exception(e)
+            return
+        self.calls += 1
+        self.rows += len(rows)
+        for future, row in zip(futures, returned): future.set_result(row)
+
+    def close(self):
+        """Send everything still waiting, then stop"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+class LatencyHistogram:
+    """Counts of request latencies in power of two millisecond buckets"""
+    BUCKETS_MS = (25, 50, 100, 200, 400, 800, 1600, 3200, 6400, 12800)
+
     def __init__(self):
-        self.config = Config()
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)  # last one is everything slower
+        self.total = 0.
+        self.max = 0.
+        self.errors = 0
+        self.retries = 0
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        k = 0
+        while k < len(self.BUCKETS_MS) and ms > self.BUCKETS_MS[k]: k += 1
+        self.counts[k] += 1
+        self.total += seconds
+        if seconds > self.max: self.max = seconds
+
+    def percentile(self, p):
+        """Upper bound in ms of the bucket holding the p'th percentile"""
+        n = sum(self.counts)
+        if not n: return 0
+        seen = 0
+        for k, count in enumerate(self.counts):
+            seen += count
+            if seen >= p / 100 * n:
+                return self.BUCKETS_MS[k] if k < len(self.BUCKETS_MS) else self.max * 1000
+        return self.max * 1000
+
+    def to_str(self):
+        n = sum(self.counts)
+        return ("%d calls, %.0f avg/%.0f max ms, p50 <%.0f p95 <%.0f ms, %d retries, %d errors" %
+                (n, 1000 * self.total / max(n, 1), 1000 * self.max, self.percentile(50),
+                 self.percentile(95), self.retries, self.errors))
+
+class Appsheet:
+    RETRIES = 3             # after the first try, on 5xx, timeouts and connection errors, see post()
+    BACKOFF_SECS = .5       # first retry waits up to this, doubling each time
+    BACKOFF_MAX_SECS = 8.
+    POOL_SIZE = 8           # keep-alive connections per host, enough for the pusher's workers
+
+    def __init__(self, config=None):
+        self.config = config or Config()
         self.headers = {"ApplicationAccessKey":
             self.config.private_vars["appsheet"]["accesskey"]}
+        self.batcher = None
+        self.outbox = None
+        # one keep-alive session for all threads, so each op doesn't pay for a TLS handshake
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=self.POOL_SIZE))
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=self.POOL_SIZE))
+        self.latency = defaultdict(LatencyHistogram)     # url: LatencyHistogram
+        self.latency_lock = threading.Lock()
+
+    def enable_batching(self, max_rows=20, window=.5):
+        """Send add/update rows in batches from now on, see RowBatcher"""
+        if not self.batcher: self.batcher = RowBatcher(self.sendop, max_rows, window)
+
+    def enable_outbox(self, path):
+        """
+        Queue op and CPE writes in a durable outbox at path and send them
+        from a background thread, see outbox.py
+        """
+        if not self.outbox: self.outbox = outbox.Outbox(path, self)
+
+    def close(self):
+        if self.batcher: self.batcher.close()
+        if self.outbox: self.outbox.close()
+
+    def send_rows(self, table, action, rows, retries=None):
+        """
+        Add or Edit rows in table in one call, returns the rows AppSheet
+        sends back.  retries: overrides RETRIES, see post()
+        """
+        body = copy.deepcopy(BODY)
+        body["Action"] = action
+        body["Rows"] = rows
+        ret = self.sendop(self.config.private_vars["appsheet"][table + "_url"], body,
+                          retries=retries)
+        return (ret.get("Rows") if isinstance(ret, dict) else None) or []
+
+    def send_row(self, url, action, row):
+        """
+        Add or Edit one row.  Returns a Future for the row AppSheet sends
+        back, which is already done unless batching is enabled.
+        """
+        if self.batcher: return self.batcher.submit(url, action, row)
+        future = Future()
+        body = copy.deepcopy(BODY)
+        body["Action"] = action
+        body["Rows"] = [row]
+        try:
+            ret = self.sendop(url, body)
+            returned = ret.get("Rows") if isinstance(ret, dict) else None
+            future.set_result(returned[0] if returned else None)
+        except Exception as e:
+            future.set_exception(e)
+        return future
 
     def aircraft_lookup(self, tail, wholeobj=False):
         """return appsheet internal ID for this tail number """
@@ -61,19 +257,16 @@ class Appsheet:
         """Create aircraft in appsheet"""
         dbg("add_aircraft %s" % (regno))
 
-        body = copy.deepcopy(BODY)
-        body["Action"] = "Add"
-        body["Rows"] = [{
+        row = {
             "regno": regno,
             "test": test,
             "description": description
-        }]
-        #ppd(self.headers)
-        #ppd(body)
+        }
         try:
             if SEND_AIRCRAFT :
-                ret = self.sendop(self.config.private_vars["appsheet"]["aircraft_url"], body)
-                return ret["Rows"][0]["Row ID"]
+                ret = self.send_row(self.config.private_vars["appsheet"]["aircraft_url"],
+                                    "Add", row).result()
+                return ret["Row ID"]
             else:
                 return FAKE_KEY
         except Exception as e:
@@ -83,19 +276,31 @@ class Appsheet:
 
     def get_all_entries(self, table):
         dbg("get_all_entries " + table)
-
-        body = copy.deepcopy(BODY)
-        body["Action"] = "Find"
-        #ppd(body)
-        url = table + "_url"
         try:
-            ret = self.sendop(self.config.private_vars["appsheet"][url], body)
+            ret = self.find_all(table)
             if ret:
                 return ret
         except Exception:
             pass
         return None
 
+    def find_all(self, table, selector=None):
+        """
+        All rows in table, or those selector picks, e.g.
+        'Filter(Ops, [Regno] = "N123")'.  Raises if the call fails
+        """
+        body = copy.deepcopy(BODY)
+        body["Action"] = "Find"
+        if selector: body["Properties"]["Selector"] = selector
+        url = table + "_url"
+        return self.sendop(self.config.private_vars["appsheet"][url], body) or []
+
+    def table_name(self, table):
+        """AppSheet's name for table, for selectors: the <name> in its .../tables/<name>/Action url"""
+        path = urlsplit(self.config.private_vars["appsheet"][table + "_url"]).path.split("/")
+        if "tables" in path[:-1]: return unquote(path[path.index("tables") + 1])
+        return table
+
     def delete_all_entries(self, table):
         allentries = self.get_all_entries(table)
         deleterows = []
@@ -139,9 +344,7 @@ class Appsheet:
         dbg("add_op %s %s" % (aircraft, optype))
         optime = datetime.datetime.fromtimestamp(time)
 
-        body = copy.deepcopy(BODY)
-        body["Action"] = "Add"
-        body["Rows"] = [{
+        row = {
             "Aircraft": aircraft,
             "Scenic": scenic,
             #"test": True,
@@ -149,11 +352,16 @@ class Appsheet:
             "optype": optype,
             "Time": optime.strftime("%m/%d/%Y %H:%M:%S"),
             "Flight Name": flight_name
-        }]
+        }
 
         try:
-            if SEND_OPS:
-                ret = self.sendop(self.config.private_vars["appsheet"]["ops_url"], body)
+            if SEND_OPS and self.outbox:
+                self.outbox.put("ops", "Add", row)
+            elif SEND_OPS:
+                future = self.send_row(self.config.private_vars["appsheet"]["ops_url"], "Add", row)
+                # nothing needs the op's row, so don't wait for a batch to go
+                if self.batcher: future.add_done_callback(log_failure("add_op"))
+                else: future.result()
             return True
         except Exception:
             log("add_op raised exception")
@@ -165,9 +373,7 @@ class Appsheet:
         log("add_cpe %s %s" % (flight1, flight2))
         optime = datetime.datetime.fromtimestamp(time)
 
-        body = copy.deepcopy(BODY)
-        body["Action"] = "Add"
-        body["Rows"] = [{
+        row = {
             "Aircraft1": flight1,
             "Aircraft2": flight2,
             "Time": optime.strftime("%m/%d/%Y %H:%M:%S"),
@@ -175,12 +381,15 @@ class Appsheet:
             "Min lat sep": latdist*6076,
             "lat": lat,
             "long": long
-        }]
-        #ppd(body)
+        }
         try:
+            if SEND_CPES and self.outbox:
+                # update_cpe takes this in place of the Row ID
+                return self.outbox.put("cpe", "Add", row)
             if SEND_CPES:
-                ret = self.sendop(self.config.private_vars["appsheet"]["cpe_url"], body)
-                return ret["Rows"][0]["Row ID"]
+                ret = self.send_row(self.config.private_vars["appsheet"]["cpe_url"],
+                                    "Add", row).result()
+                return ret["Row ID"]
             else:
                 return FAKE_KEY
         except Exception:
@@ -190,9 +399,7 @@ class Appsheet:
     def update_cpe(self, flight1, flight2, latdist, altdist, time, rowid):
         log("update_cpe %s %s" % (flight1, flight2))
         optime = datetime.datetime.fromtimestamp(time)
-        body = copy.deepcopy(BODY)
-        body["Action"] = "Edit"
-        body["Rows"] = [{
+        row = {
             "Row ID": rowid,
             "Aircraft1": flight1,
             "Aircraft2": flight2,
@@ -200,20 +407,22 @@ class Appsheet:
             "Min alt sep": altdist,
             "Min lat sep": latdist*6076,
             "Final": True
-        }]
-        #ppd(body)
+        }
 
         try:
+            if SEND_CPES and self.outbox:
+                depends = rowid if outbox.is_key(rowid) else None
+                return self.outbox.put("cpe", "Edit", row, depends)
             if SEND_CPES:
-                ret = self.sendop(self.config.private_vars["appsheet"]["cpe_url"], body)
-                return ret
+                return self.send_row(self.config.private_vars["appsheet"]["cpe_url"],
+                                     "Edit", row).result()
             else:
                 return FAKE_KEY
         except Exception:
             log("update_cpe op raised exception")
         return None
 
-    def sendop(self, url, body, timeout=30):
+    def sendop(self, url, body, timeout=30, retries=None):
         log("sending to url "+url)
         response_dict = None
 
@@ -222,12 +431,10 @@ class Appsheet:
             log(f"delaying {delay}")
             time.sleep(delay)
 
-        response = requests.post(
-            url,
-            headers=self.headers, json=body, timeout=timeout)
+        response = self.post(url, body, timeout, retries)
         if response.status_code != 200:
             ppd(response)
-            raise Exception("op returned non-200 code: "+str(response))
+            raise AppsheetError("op returned non-200 code: "+str(response), response.status_code)
         # ppd(response)
         if not response.text: return None
         response_dict = json.loads(response.text)
@@ -237,6 +444,50 @@ class Appsheet:
 
         return response_dict
 
+    def post(self, url, body, timeout, retries=None):
+        """
+        POST body to url on the shared session.  5xx responses, timeouts
+        and connection errors are retried up to retries (default RETRIES)
+        times with jittered exponential backoff.  The last response is
+        returned, or the last exception raised.  An Add that failed after
+        it was sent may have gone through anyway, so Adds are only retried
+        if the connection couldn't be made.
+        """
+        if retries is None: retries = self.RETRIES
+        add = body.get("Action") == "Add"
+        for attempt in range(retries + 1):
+            start = time.monotonic()
+            error = response = None
+            try:
+                response = self.session.post(url, headers=self.headers, json=body, timeout=timeout)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                error = e
+            elapsed = time.monotonic() - start
+
+            failed = error is not None or response.status_code >= 500
+            retry = failed and attempt < retries and (not add or
+                                                      (error is not None and never_sent(error)))
+            with self.latency_lock:
+                histogram = self.latency[url]
+                histogram.add(elapsed)
+                if failed: histogram.errors += 1
+                if retry: histogram.retries += 1
+            if not retry: break
+
+            backoff = random.uniform(0, min(self.BACKOFF_MAX_SECS, self.BACKOFF_SECS * 2 ** attempt))
+            log("appsheet %s, retrying in %.1fs" %
+                (error or "HTTP %d" % response.status_code, backoff))
+            time.sleep(backoff)
+
+        if error is not None: raise error
+        return response
+
+    def latency_report(self):
+        """Per url latency histogram summaries, for print_stats"""
+        with self.latency_lock:
+            return ["...%s: %s" % (url[-20:], histogram.to_str())
+                    for url, histogram in self.latency.items()]
+
 if __name__ == "__main__":
     set_dbg_level(2)
     as_instance = Appsheet()
@@ -1,14 +1,46 @@
 #!/usr/bin/python3
 
+import bisect
+import hashlib
+import math
+import os
 import pprint
+import random
 import re
-from fastkml import kml
+import struct
+import sys
+import numpy as np
 from shapely.geometry import Point, LineString, Polygon
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+try:
+    # shapely 2.x: the polygon itself, already prepared in place by prep()
+    from shapely import contains_xy
+    VECTORIZED_PREPARED = False
+except ImportError:
+    # shapely 1.8: takes a PreparedGeometry
+    from shapely.vectorized import contains as contains_xy
+    VECTORIZED_PREPARED = True
 from dataclasses import dataclass
-from dbg import dbg
+from dbg import dbg, log
 
 pp = pprint.PrettyPrinter(indent=4)
 
+GRID_RESOLUTION = .001      # degrees per side of a BboxGrid cell, 0 disables the grid
+GRID_MAX_CELLS = 1000000    # refuse to build grids bigger than this
+
+# Compiled gate cache, stored next to the KML (sjc.kml -> sjc.kmlc) and
+# keyed by the KML's sha256 so edits are picked up.  Layout, little-endian:
+#   header: magic, version, sha256, box count
+#   per box: minalt maxalt starthdg endhdg, name length + utf-8 name, ring count,
+#            then per ring (exterior first): point count + lon/lat float64 pairs
+CACHE_SUFFIX = "c"
+CACHE_MAGIC = b"BBXC"
+CACHE_VERSION = 1
+CACHE_HEADER = struct.Struct("<4sH32sI")
+CACHE_BOX = struct.Struct("<iiiiH")
+CACHE_COUNT = struct.Struct("<I")
+
 @dataclass
 class Bbox:
     """A single bounding box defined by a polygon, altitude range, and heading range."""
@@ -19,6 +51,337 @@ class Bbox:
     endhdg: int
     name: str
 
+def read_cache(path, digest):
+    """Boxes from a compiled cache file, or None if missing, stale or corrupt"""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version, file_digest, nboxes = CACHE_HEADER.unpack_from(data, 0)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION or file_digest != digest:
+            return None
+        offset = CACHE_HEADER.size
+        boxes = []
+        for _ in range(nboxes):
+            minalt, maxalt, starthdg, endhdg, namelen = CACHE_BOX.unpack_from(data, offset)
+            offset += CACHE_BOX.size
+            name = data[offset:offset + namelen].decode('utf-8')
+            offset += namelen
+            (nrings,) = CACHE_COUNT.unpack_from(data, offset)
+            offset += CACHE_COUNT.size
+            rings = []
+            for _ in range(nrings):
+                (npoints,) = CACHE_COUNT.unpack_from(data, offset)
+                offset += CACHE_COUNT.size
+                rings.append(np.frombuffer(data, dtype='<f8', count=2 * npoints,
+                    offset=offset).reshape(-1, 2).tolist())
+                offset += 16 * npoints
+            boxes.append(Bbox(polygon=Polygon(rings[0], rings[1:]), minalt=minalt,
+                maxalt=maxalt, starthdg=starthdg, endhdg=endhdg, name=name))
+        return boxes
+    except (OSError, struct.error, ValueError):
+        return None
+
+def write_cache(path, digest, boxes):
+    parts = [CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, digest, len(boxes))]
+    for box in boxes:
+        name = box.name.encode('utf-8')
+        rings = [box.polygon.exterior] + list(box.polygon.interiors)
+        parts.append(CACHE_BOX.pack(box.minalt, box.maxalt, box.starthdg, box.endhdg, len(name)))
+        parts.append(name)
+        parts.append(CACHE_COUNT.pack(len(rings)))
+        for ring in rings:
+            coords = np.asarray(ring.coords, dtype='<f8')[:, :2]
+            parts.append(CACHE_COUNT.pack(len(coords)))
+            parts.append(coords.tobytes())
+    try:
+        tmp = path + ".tmp"
+        with open(tmp, 'wb') as f:
+            f.write(b"".join(parts))
+        os.replace(tmp, path)
+    except OSError as e:
+        log("Couldn't write gate cache %s: %s" % (path, str(e)))
+
+class BboxGrid:
+    """
+    Coarse lat/lon grid over a set of polygons, precomputed at load time so
+    most positions can be classified with an array lookup.  Each cell holds
+    OUTSIDE if no polygon touches it, BOUNDARY if a polygon edge passes
+    through it and the exact test is needed, or else an index into
+    candidates, the tuple of polygons that contain the whole cell.
+    """
+    OUTSIDE = -1
+    BOUNDARY = -2
+
+    def __init__(self, polygons, resolution):
+        self.res = resolution
+        bounds = np.array([p.bounds for p in polygons])
+        self.x0 = bounds[:, 0].min()
+        self.y0 = bounds[:, 1].min()
+        self.nx = int((bounds[:, 2].max() - self.x0) / resolution) + 1
+        self.ny = int((bounds[:, 3].max() - self.y0) / resolution) + 1
+        if self.nx * self.ny > GRID_MAX_CELLS:
+            raise ValueError("grid would have %d cells, use a coarser resolution" %
+                (self.nx * self.ny))
+
+        boundary = np.zeros((self.ny, self.nx), dtype=bool)
+        inside = np.zeros((self.ny, self.nx, len(polygons)), dtype=bool)
+        for k, polygon in enumerate(polygons):
+            edges = np.zeros((self.ny, self.nx), dtype=bool)
+            for ring in [polygon.exterior] + list(polygon.interiors):
+                self.mark_ring(edges, np.asarray(ring.coords)[:, :2])
+
+            # cells no edge passes through are all in or all out, the center decides
+            ix0, ix1 = self.index(np.array([bounds[k, 0], bounds[k, 2]]), self.x0, self.nx)
+            iy0, iy1 = self.index(np.array([bounds[k, 1], bounds[k, 3]]), self.y0, self.ny)
+            cx, cy = np.meshgrid(self.x0 + (np.arange(ix0, ix1 + 1) + .5) * resolution,
+                                 self.y0 + (np.arange(iy0, iy1 + 1) + .5) * resolution)
+            geom = prep(polygon) if VECTORIZED_PREPARED else polygon
+            centers_in = contains_xy(geom, cx.ravel(), cy.ravel()).reshape(cx.shape)
+            inside[iy0:iy1+1, ix0:ix1+1, k] = centers_in & ~edges[iy0:iy1+1, ix0:ix1+1]
+            boundary |= edges
+
+        # one code per distinct set of containing polygons.  Unique on packed
+        # bit rows, much faster than np.unique(axis=0) on the bools.
+        packed = np.packbits(inside.reshape(-1, len(polygons)), axis=1)
+        keys = np.zeros((len(packed), (packed.shape[1] + 7) // 8 * 8), dtype=np.uint8)
+        keys[:, :packed.shape[1]] = packed
+        keys = keys.view(np.uint64) if keys.shape[1] == 8 else keys.view("V%d" % keys.shape[1])
+        _, first, codes = np.unique(keys.ravel(), return_index=True, return_inverse=True)
+        self.table = inside.reshape(-1, len(polygons))[first]
+        self.candidates = [tuple(np.flatnonzero(row).tolist()) for row in self.table]
+        self.cells = codes.reshape(self.ny, self.nx).astype(np.int32)
+        self.cells[~self.table.any(axis=1)[self.cells]] = self.OUTSIDE
+        self.cells[boundary] = self.BOUNDARY
+        self.cells_list = self.cells.tolist()   # faster than numpy for single lookups
+        self.clearance_list = self.edge_clearance(boundary).tolist()
+        dbg("Bbox grid %dx%d cells, %d boundary" % (self.nx, self.ny, boundary.sum()))
+
+    def edge_clearance(self, boundary):
+        """
+        Per cell, a lower bound in degrees on the distance from any point in
+        the cell to a polygon edge, from the city block distance in cells to
+        the nearest boundary cell.  Computed with min-accumulate sweeps.
+        """
+        big = self.nx + self.ny + 2
+        d = np.where(boundary, 0, big).astype(np.int64)
+        for axis in (1, 0):
+            steps = np.arange(d.shape[axis]).reshape((1, -1) if axis else (-1, 1))
+            forward = np.minimum.accumulate(d - steps, axis=axis) + steps
+            backward = np.flip(np.minimum.accumulate(np.flip(d + steps, axis), axis=axis), axis) - steps
+            d = np.minimum(forward, backward)
+        # chessboard distance is at least half the city block distance, and
+        # points in cells n apart in chessboard terms are (n-1) cells apart
+        return np.maximum(np.ceil(d / 2) - 1, 0) * self.res
+
+    def clearance(self, lat, lon):
+        """Lower bound in degrees on the distance from lat/lon to a polygon edge"""
+        fx = (lon - self.x0) / self.res
+        fy = (lat - self.y0) / self.res
+        if fx < 0 or fy < 0 or fx >= self.nx or fy >= self.ny:
+            # outside the grid, use the distance to it
+            dx = max(-fx, 0., fx - self.nx)
+            dy = max(-fy, 0., fy - self.ny)
+            return math.hypot(dx, dy) * self.res
+        return self.clearance_list[int(fy)][int(fx)]
+
+    def index(self, values, origin, n):
+        return np.clip(np.floor((values - origin) / self.res).astype(int), 0, n - 1)
+
+    def mark_ring(self, cells, coords):
+        """
+        Mark every cell an edge of the ring passes through or near.  Edges
+        are cut into pieces shorter than half a cell, so each piece's
+        (slightly padded) envelope spans at most 2x2 cells.
+        """
+        step = self.res / 2
+        pad = self.res * 1e-3
+        for (xa, ya), (xb, yb) in zip(coords[:-1], coords[1:]):
+            t = np.linspace(0., 1., int(math.hypot(xb - xa, yb - ya) / step) + 2)
+            xs = xa + (xb - xa) * t
+            ys = ya + (yb - ya) * t
+            ix_lo = self.index(np.minimum(xs[:-1], xs[1:]) - pad, self.x0, self.nx)
+            ix_hi = self.index(np.maximum(xs[:-1], xs[1:]) + pad, self.x0, self.nx)
+            iy_lo = self.index(np.minimum(ys[:-1], ys[1:]) - pad, self.y0, self.ny)
+            iy_hi = self.index(np.maximum(ys[:-1], ys[1:]) + pad, self.y0, self.ny)
+            for iy in (iy_lo, iy_hi):
+                for ix in (ix_lo, ix_hi):
+                    cells[iy, ix] = True
+
+    def lookup(self, lat, lon):
+        """Cell value for one position"""
+        fx = (lon - self.x0) / self.res
+        fy = (lat - self.y0) / self.res
+        if fx < 0 or fy < 0 or fx >= self.nx or fy >= self.ny:
+            return self.OUTSIDE
+        return self.cells_list[int(fy)][int(fx)]
+
+    def lookup_many(self, lats, lons):
+        """Cell values for arrays of positions"""
+        fx = (lons - self.x0) / self.res
+        fy = (lats - self.y0) / self.res
+        valid = (fx >= 0) & (fy >= 0) & (fx < self.nx) & (fy < self.ny)
+        codes = np.full(len(lats), self.OUTSIDE, dtype=np.int32)
+        codes[valid] = self.cells[fy[valid].astype(int), fx[valid].astype(int)]
+        return codes
+
+class BboxIndex:
+    """
+    The boxes from one load of a KML file, plus prepared polygons, STRtree
+    and grid built from them.  Bboxes swaps in a new BboxIndex when its KML
+    changes, so readers grab Bboxes.index once and use it throughout.
+    """
+    def __init__(self, boxes, grid_resolution):
+        self.boxes = boxes
+        self.prepared = [prep(box.polygon) for box in boxes]
+        self.tree = STRtree([box.polygon for box in boxes]) if boxes else None
+        self.grid = None
+        if boxes and grid_resolution:
+            try:
+                self.grid = BboxGrid([box.polygon for box in boxes], grid_resolution)
+            except ValueError as e:
+                log("Not using bbox grid: " + str(e))
+
+        self.bounds = [box.polygon.bounds for box in boxes]
+        # (minx, miny, maxx, maxy) around every box, None if there are none
+        self.extent = None
+        if boxes:
+            self.extent = (min(b[0] for b in self.bounds), min(b[1] for b in self.bounds),
+                           max(b[2] for b in self.bounds), max(b[3] for b in self.bounds))
+        self.edges = [box.polygon.boundary for box in boxes]
+        self.alt_limits = (sorted(box.minalt for box in boxes), sorted(box.maxalt for box in boxes))
+        self.hdg_limits = (sorted(box.starthdg for box in boxes), sorted(box.endhdg for box in boxes))
+
+    def edge_clearance(self, lat, lon):
+        """Lower bound in degrees on the distance from lat/lon to a polygon edge"""
+        if self.grid: return self.grid.clearance(lat, lon)
+        return self.edge_distance(lat, lon)
+
+    def edge_distance(self, lat, lon):
+        """Distance in degrees from lat/lon to the nearest polygon edge"""
+        best = math.inf
+        point = None
+        for (minx, miny, maxx, maxy), edges in zip(self.bounds, self.edges):
+            # distance to the envelope is a lower bound, skip far polygons
+            dx = max(minx - lon, 0., lon - maxx)
+            dy = max(miny - lat, 0., lat - maxy)
+            if dx * dx + dy * dy >= best * best: continue
+            if point is None: point = Point(lon, lat)
+            best = min(best, edges.distance(point))
+        return best
+
+    def tree_query(self, geom):
+        """Indices of boxes whose envelope intersects geom"""
+        if hasattr(self.tree, "query_items"):
+            return self.tree.query_items(geom)    # shapely 1.8
+        return self.tree.query(geom)              # shapely 2.x returns indices
+
+def stable_range(value, ge_limits, le_limits):
+    """
+    Return (lo, hi, lo_x, hi_x) such that for any v with lo <= v < hi and
+    lo_x < v <= hi_x, the tests v >= g and v <= l come out the same as
+    for value, for every g in ge_limits and l in le_limits (both sorted).
+    """
+    i = bisect.bisect_right(ge_limits, value)
+    lo = ge_limits[i - 1] if i else -math.inf
+    hi = ge_limits[i] if i < len(ge_limits) else math.inf
+    j = bisect.bisect_left(le_limits, value)
+    lo_x = le_limits[j - 1] if j else -math.inf
+    hi_x = le_limits[j] if j < len(le_limits) else math.inf
+    return lo, hi, lo_x, hi_x
+
+class ContainsResult:
+    """
+    A contains() result, plus how far the inputs can change before the
+    result could: the distance to the nearest polygon edge, and the range
+    of altitudes and headings that test the same against every box limit.
+    Lets a moving aircraft skip geometry until it gets near an edge.
+    """
+    __slots__ = ("box", "index", "lat", "lon", "margin2", "expires",
+                 "alt_range", "hdg_range")
+    SAFETY = .999                   # shrink the margin a little for rounding
+    DEGREES_PER_NM = 1. / 59.       # a bit more than the real 1/60 to be conservative
+
+    def __init__(self, box, index, lat, lon, hdg, alt, now, gs):
+        self.box = box
+        self.index = index
+        self.lat = lat
+        self.lon = lon
+        margin = index.edge_clearance(lat, lon) * self.SAFETY
+        self.margin2 = margin * margin
+        # how long until it could have flown that far at its current speed
+        self.expires = math.inf
+        if gs:
+            deg_per_sec = gs / 3600. * self.DEGREES_PER_NM / max(math.cos(math.radians(lat)), .01)
+            self.expires = (now or 0) + margin / deg_per_sec
+        self.alt_range = stable_range(alt, *index.alt_limits)
+        self.hdg_range = stable_range(hdg, *index.hdg_limits)
+
+    def valid(self, lat, lon, hdg, alt, now, index):
+        """Is box still the contains() result for these inputs?"""
+        if index is not self.index or (now or 0) >= self.expires: return False
+        dlat = lat - self.lat
+        dlon = lon - self.lon
+        if dlat * dlat + dlon * dlon >= self.margin2: return False
+        lo, hi, lo_x, hi_x = self.alt_range
+        if not (lo <= alt < hi and lo_x < alt <= hi_x): return False
+        lo, hi, lo_x, hi_x = self.hdg_range
+        return lo <= hdg < hi and lo_x < hdg <= hi_x
+
+def same_box(a, b):
+    return (a.minalt == b.minalt and a.maxalt == b.maxalt and a.starthdg == b.starthdg
+            and a.endhdg == b.endhdg and a.polygon.equals_exact(b.polygon, 0))
+
+class BboxReload:
+    """
+    Differences between the old and new BboxIndex of a reloaded KML file.
+    Boxes are matched up by name; a box counts as changed if it's new,
+    gone, or its polygon or limits differ.
+    """
+    REMOVED = -2    # remap() result for a box that no longer exists
+    NEAR = .01      # degrees around changed boxes where flights get re-evaluated
+
+    def __init__(self, old_index, new_index):
+        self.old_index = old_index
+        self.new_index = new_index
+
+        new_by_name = {}
+        for j, box in enumerate(new_index.boxes):
+            new_by_name.setdefault(box.name, []).append(j)
+        self.old_to_new = []
+        self.changed_old = set()
+        changed_geoms = []
+        for i, box in enumerate(old_index.boxes):
+            same_name = new_by_name.get(box.name)
+            j = same_name.pop(0) if same_name else self.REMOVED
+            self.old_to_new.append(j)
+            if j == self.REMOVED:
+                self.changed_old.add(i)
+                changed_geoms.append(box.polygon)
+            elif not same_box(box, new_index.boxes[j]):
+                self.changed_old.add(i)
+                changed_geoms += [box.polygon, new_index.boxes[j].polygon]
+        for same_name in new_by_name.values():
+            changed_geoms += [new_index.boxes[j].polygon for j in same_name]   # added boxes
+        self.changed_bounds = [geom.bounds for geom in changed_geoms]
+
+        # first match wins, so if surviving boxes were reordered play it safe
+        survivors = [j for j in self.old_to_new if j >= 0]
+        self.reordered = survivors != sorted(survivors)
+
+    def remap(self, old_i):
+        """New index for a box index from the old BboxIndex, or REMOVED"""
+        if old_i < 0: return old_i
+        return self.old_to_new[old_i]
+
+    def affects(self, old_i, lat, lon):
+        """Does a flight at lat/lon that was inside old box old_i need re-evaluating?"""
+        if self.reordered or old_i in self.changed_old: return True
+        for minx, miny, maxx, maxy in self.changed_bounds:
+            if (minx - self.NEAR <= lon <= maxx + self.NEAR and
+                miny - self.NEAR <= lat <= maxy + self.NEAR):
+                return True
+        return False
+
 class Bboxes:
     """
     A collection of Bbox objects, defined by a KML file with polygons inside.
@@ -26,18 +389,82 @@ class Bboxes:
         name: minalt-maxalt minhdg-maxhdg
     For example:
         RHV apporach: 500-1500 280-320
+    The KML file can be edited while running, see check_reload().
     """
-    def __init__(self, fn):
-        self.boxes = []    # list of Bbox objects
+    def __init__(self, fn, grid_resolution=GRID_RESOLUTION, use_cache=True):
+        self.fn = fn
+        self.grid_resolution = grid_resolution
+
+        self.file_stat = self.stat()
+        boxes, self.digest = self.load(use_cache)
+        self.index = BboxIndex(boxes, grid_resolution)
+
+    @property
+    def boxes(self):
+        """list of Bbox objects"""
+        return self.index.boxes
+
+    @property
+    def extent(self):
+        """(min lon, min lat, max lon, max lat) around all boxes, or None if none"""
+        return self.index.extent
 
-        with open(fn, 'rt', encoding="utf-8") as myfile:
-          doc = myfile.read()
+    def stat(self):
+        st = os.stat(self.fn)
+        return (st.st_mtime_ns, st.st_size)
+
+    def load(self, use_cache=True):
+        """
+        Return (boxes, KML digest), from the compiled cache if it matches
+        the KML, otherwise by parsing the KML and (re)writing the cache.
+        """
+        with open(self.fn, 'rb') as myfile:
+            raw = myfile.read()
+        digest = hashlib.sha256(raw).digest()
+        cache_fn = self.fn + CACHE_SUFFIX
+
+        if use_cache:
+            boxes = read_cache(cache_fn, digest)
+            if boxes is not None:
+                dbg("Loaded %d bounding boxes from %s" % (len(boxes), cache_fn))
+                return boxes, digest
+
+        from fastkml import kml   # slow import, only needed on a cache miss
         k = kml.KML()
-        k.from_string(doc.encode('utf-8'))
+        k.from_string(raw)
         features = list(k.features())
-        self.parse_placemarks(features)
+        boxes = []
+        self.parse_placemarks(features, boxes)
+        write_cache(cache_fn, digest, boxes)
+        return boxes, digest
+
+    def check_reload(self):
+        """
+        If the KML file has changed, load and compile it and return a
+        BboxReload describing the changes, else None.  The new boxes
+        aren't used until the BboxReload is passed to install().
+        """
+        try:
+            file_stat = self.stat()
+            if file_stat == self.file_stat: return None
+            self.file_stat = file_stat
+            boxes, digest = self.load()
+        except Exception as e:
+            # probably caught mid-save, try again when it changes next
+            log("KML reload of %s failed: %s" % (self.fn, str(e)))
+            return None
+        if digest == self.digest: return None
 
-    def parse_placemarks(self, document):
+        log("Reloading %d bounding boxes from %s" % (len(boxes), self.fn))
+        self.digest = digest
+        return BboxReload(self.index, BboxIndex(boxes, self.grid_resolution))
+
+    def install(self, reload):
+        """Atomically switch over to the boxes from check_reload()"""
+        self.index = reload.new_index
+
+    def parse_placemarks(self, document, boxes):
+        from fastkml import kml
         for feature in document:
           if isinstance(feature, kml.Placemark):
             re_result = re.search(r"^([^:]+):\s*(\d+)-(\d+)\s+(\d+)-(\d+)",
@@ -56,12 +483,12 @@ class Bboxes:
             newbox = Bbox(polygon=Polygon(feature.geometry),
                 minalt=minalt, maxalt=maxalt, starthdg=starthdg,
                 endhdg=endhdg, name=name)
-            self.boxes.append(newbox)
+            boxes.append(newbox)
         for feature in document:
           if isinstance(feature, kml.Folder):
-              self.parse_placemarks(list(feature.features()))
+              self.parse_placemarks(list(feature.features()), boxes)
           if isinstance(feature, kml.Document):
-              self.parse_placemarks(list(feature.features()))
+              self.parse_placemarks(list(feature.features()), boxes)
 
     def hdg_contains(self, hdg, start, end):
         try:
@@ -71,11 +498,173 @@ class Bboxes:
         except:
             exit(1)
 
-    def contains(self, lat, long, hdg, alt):
+    def contains_cached(self, lat, long, hdg, alt, now, gs, cached=None):
+        """
+        contains() for a moving aircraft.  cached is the ContainsResult
+        from its previous call, reused if the aircraft can't have crossed
+        any box limit since.  Returns a ContainsResult, see its .box.
+        """
+        index = self.index
+        if cached and cached.valid(lat, long, hdg, alt, now, index):
+            return cached
+        return ContainsResult(self.contains(lat, long, hdg, alt, index), index,
+                              lat, long, hdg, alt, now, gs)
+
+    def contains(self, lat, long, hdg, alt, index=None):
         "returns index of first matching bounding box, or -1 if not found"
-        for i, box in enumerate(self.boxes):
-            if (box.polygon.contains(Point(long,lat)) and
-                self.hdg_contains(hdg, box.starthdg, box.endhdg)):
-                if (alt >= box.minalt and alt <= box.maxalt):
-                    return i
+        if index is None: index = self.index
+        if index.grid:
+            cell = index.grid.lookup(lat, long)
+            if cell == BboxGrid.OUTSIDE: return -1
+            if cell != BboxGrid.BOUNDARY:
+                for i in index.grid.candidates[cell]:
+                    box = index.boxes[i]
+                    if (alt >= box.minalt and alt <= box.maxalt and
+                        self.hdg_contains(hdg, box.starthdg, box.endhdg)):
+                        return i
+                return -1
+        return self.contains_exact(lat, long, hdg, alt, index)
+
+    def contains_exact(self, lat, long, hdg, alt, index=None):
+        "contains() without the grid"
+        if index is None: index = self.index
+        # altitude and heading are cheap, reject on those before any geometry
+        candidates = [i for i, box in enumerate(index.boxes)
+            if alt >= box.minalt and alt <= box.maxalt and
+               self.hdg_contains(hdg, box.starthdg, box.endhdg)]
+        if not candidates: return -1
+
+        point = Point(long, lat)
+        hits = set(index.tree_query(point))
+        for i in candidates:
+            if i in hits and index.prepared[i].contains(point):
+                return i
         return -1
+
+    def hdg_mask(self, hdgs, start, end):
+        """Vectorized hdg_contains()"""
+        if end < start:
+            return (hdgs >= start) | (hdgs <= end)
+        return (hdgs >= start) & (hdgs <= end)
+
+    def contains_many(self, lats, lons, hdgs, alts):
+        """
+        Vectorized contains() over arrays of positions.  Returns an int array
+        with the index of the first matching box for each position, or -1.
+        """
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        hdgs = np.asarray(hdgs, dtype=float)
+        alts = np.asarray(alts, dtype=float)
+        index = self.index
+        grid = index.grid
+        result = np.full(len(lats), -1, dtype=np.int32)
+        unresolved = np.ones(len(lats), dtype=bool)
+        if grid:
+            codes = grid.lookup_many(lats, lons)
+            unresolved &= codes != BboxGrid.OUTSIDE
+            gridded = codes >= 0
+            exact = codes == BboxGrid.BOUNDARY
+            codes[~gridded] = 0
+
+        for i, box in enumerate(index.boxes):
+            mask = (unresolved & (alts >= box.minalt) & (alts <= box.maxalt) &
+                    self.hdg_mask(hdgs, box.starthdg, box.endhdg))
+            if grid:
+                hits = mask & gridded & grid.table[codes, i]
+                result[hits] = i
+                unresolved[hits] = False
+                mask &= exact
+
+            minx, miny, maxx, maxy = box.polygon.bounds
+            mask &= (lons >= minx) & (lons <= maxx) & (lats >= miny) & (lats <= maxy)
+            candidates = np.flatnonzero(mask)
+            if not len(candidates): continue
+
+            geom = index.prepared[i] if VECTORIZED_PREPARED else box.polygon
+            inside = candidates[contains_xy(geom, lons[candidates], lats[candidates])]
+            result[inside] = i
+            unresolved[inside] = False
+        return result
+
+    def verify_grid(self, n_points=100000, seed=0):
+        """
+        Check contains() and contains_many() against contains_exact() at
+        random positions around the boxes, plus polygon vertices and edge
+        midpoints.  Returns the number of mismatches.
+        """
+        grid = self.index.grid
+        if not grid: return 0
+        rng = random.Random(seed)
+        pad = 5 * grid.res
+        lons = [rng.uniform(grid.x0 - pad, grid.x0 + grid.nx * grid.res + pad)
+                for _ in range(n_points)]
+        lats = [rng.uniform(grid.y0 - pad, grid.y0 + grid.ny * grid.res + pad)
+                for _ in range(n_points)]
+        for box in self.boxes:
+            coords = [c[:2] for c in box.polygon.exterior.coords]
+            for (xa, ya), (xb, yb) in zip(coords[:-1], coords[1:]):
+                lons += [xa, (xa + xb) / 2]
+                lats += [ya, (ya + yb) / 2]
+
+        alt_choices = [0]
+        for box in self.boxes:
+            alt_choices += [box.minalt - 1, box.minalt, box.maxalt, box.maxalt + 1]
+        alts = [rng.choice(alt_choices) for _ in lats]
+        hdgs = [rng.uniform(0, 360) for _ in lats]
+
+        mismatches = 0
+        many = self.contains_many(lats, lons, hdgs, alts)
+        for i, args in enumerate(zip(lats, lons, hdgs, alts)):
+            expected = self.contains_exact(*args)
+            if self.contains(*args) != expected or many[i] != expected:
+                mismatches += 1
+                log("Grid mismatch at %f, %f hdg %d alt %d: exact %d grid %d vectorized %d" %
+                    (*args, expected, self.contains(*args), many[i]))
+        return mismatches
+
+def contains_many_layers(bboxes_list, lats, lons, hdgs, alts):
+    """
+    Bboxes.contains_many() for each Bboxes in bboxes_list.  Returns an
+    (n positions, n layers) matrix of box indices.
+    """
+    result = np.full((len(lats), len(bboxes_list)), -1, dtype=np.int32)
+    for layer, bboxes in enumerate(bboxes_list):
+        result[:, layer] = bboxes.contains_many(lats, lons, hdgs, alts)
+    return result
+
+if __name__ == "__main__":
+    import argparse
+    from dbg import set_dbg_level
+
+    parser = argparse.ArgumentParser(description="KML bounding box tools")
+    parser.add_argument("-d", "--debug", action="store_true")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    verify_parser = subparsers.add_parser("verify",
+        help="check that grid lookups agree exactly with polygon containment")
+    verify_parser.add_argument("--resolution", type=float, default=GRID_RESOLUTION,
+        help="grid cell size in degrees")
+    verify_parser.add_argument("--points", type=int, default=100000,
+        help="random positions to check per file")
+    verify_parser.add_argument('file', nargs='+', help="kml files to check")
+    compile_parser = subparsers.add_parser("compile",
+        help="precompile KML files into gate caches for fast startup")
+    compile_parser.add_argument('file', nargs='+', help="kml files to compile")
+    args = parser.parse_args()
+
+    if args.debug: set_dbg_level(2)
+    else: set_dbg_level(1)
+
+    if args.command == "verify":
+        failed = False
+        for fn in args.file:
+            bboxes = Bboxes(fn, grid_resolution=args.resolution)
+            mismatches = bboxes.verify_grid(args.points)
+            print("%s: %d mismatches" % (fn, mismatches))
+            if mismatches: failed = True
+        sys.exit(1 if failed else 0)
+
+    if args.command == "compile":
+        for fn in args.file:
+            bboxes = Bboxes(fn, grid_resolution=0, use_cache=False)
+            print("%s: %d boxes -> %s" % (fn, len(bboxes.boxes), fn + CACHE_SUFFIX))
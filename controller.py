@@ -317,6 +317,18 @@ class ControllerApp(MDApp):
         strip.annotate(note)
         strip.update_strip_text()
 
+    @mainthread
+    def predict_strip(self, flight1, flight2, seconds, lat_dist, alt_dist):
+        dbg("predict strip "+flight1.flight_id)
+        try:
+            strip = self.strips[flight1.flight_id]
+        except KeyError:
+            return
+        if seconds < 1: return  # already inside minimums, annotate_strip has it
+        note = "PREDICTED TRAFFIC: %s %ds" % (flight2.flight_id, seconds)
+        strip.annotate(note)
+        strip.update_strip_text()
+
     @mainthread
     def set_strip_color(self, id, color):
         try:
@@ -342,6 +354,7 @@ def run(focus_q, admin_q):
     parser.add_argument('file', nargs='+', help="kml files to use")
     parser.add_argument('--ipaddr', help="IP address to connect to", required=True)
     parser.add_argument('--port', help="port to connect to", required=True)
+    parser.add_argument('--bulk', help="read and apply socket input in batches", action="store_true")
 
     args = parser.parse_args()
     if args.debug: set_dbg_level(2)
@@ -357,7 +370,8 @@ def run(focus_q, admin_q):
     controllerapp = ControllerApp(bboxes_list[0], focus_q, admin_q)
     read_thread = threading.Thread(target=adsb_receiver.flight_read_loop,
         args=[listen_socket, bboxes_list, controllerapp.update_strip,
-        controllerapp.remove_strip, controllerapp.annotate_strip, None])
+        controllerapp.remove_strip, controllerapp.annotate_strip, None],
+        kwargs={'bulk': args.bulk, 'cpa_cb': controllerapp.predict_strip})
     Clock.schedule_once(lambda x: read_thread.start(), 2)
 
     dbg("Starting main loop")
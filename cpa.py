@@ -0,0 +1,59 @@
+"""
+Closest point of approach (CPA) between pairs of aircraft, extrapolating
+each one along its current ground track, ground speed and vertical rate.
+Fixes of different ages are first brought forward to a common time, so a
+pair is compared where both aircraft are now, not where each last reported.
+
+Positions are projected onto a flat plane tangent at each pair's midpoint,
+plenty accurate at the few nm ranges this is used for.
+"""
+
+import numpy as np
+
+NM_PER_DEGREE = 60.
+
+def closest_approach(lats, lons, alts, gss, tracks, vrates, first, second, horizon,
+                     nows=None, when=None):
+    """
+    For each pair first[k], second[k] (indices into the other arrays:
+    degrees, feet, knots, degrees true, feet/sec) returns arrays
+    (t, dist, altsep): seconds from when to the closest approach, clamped to
+    [0, horizon], and the horizontal (nm) and vertical (ft) separation then.
+    nows are the times of each fix; if given, each aircraft is extrapolated
+    from its fix to when before solving.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    alts = np.asarray(alts, dtype=np.float64)
+    trk = np.radians(np.asarray(tracks, dtype=np.float64))
+    speed = np.asarray(gss, dtype=np.float64) / 3600.      # nm/sec
+    vx = speed * np.sin(trk)
+    vy = speed * np.cos(trk)
+    vz = np.asarray(vrates, dtype=np.float64)
+    first = np.asarray(first, dtype=np.intp)
+    second = np.asarray(second, dtype=np.intp)
+
+    # position and velocity of second relative to first
+    mid_lat = np.radians((lats[first] + lats[second]) * .5)
+    dlon = (lons[second] - lons[first] + 180.) % 360. - 180.
+    rx = dlon * np.cos(mid_lat) * NM_PER_DEGREE
+    ry = (lats[second] - lats[first]) * NM_PER_DEGREE
+    dvx = vx[second] - vx[first]
+    dvy = vy[second] - vy[first]
+    dz = alts[second] - alts[first]
+    if nows is not None:
+        age = np.maximum(when - np.asarray(nows, dtype=np.float64), 0.)
+        age1 = age[first]
+        age2 = age[second]
+        rx = rx + vx[second] * age2 - vx[first] * age1
+        ry = ry + vy[second] * age2 - vy[first] * age1
+        dz = dz + vz[second] * age2 - vz[first] * age1
+
+    closing = dvx * dvx + dvy * dvy
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.where(closing > 1e-12, -(rx * dvx + ry * dvy) / closing, 0.)
+    t = np.clip(t, 0., horizon)
+
+    dist = np.hypot(rx + dvx * t, ry + dvy * t)
+    altsep = np.abs(dz + (vz[second] - vz[first]) * t)
+    return t, dist, altsep
@@ -0,0 +1,123 @@
+"""
+Runs callbacks on worker threads so slow subscribers (GUI, network
+pushes) don't hold up ingest.  Callbacks with the same key, e.g. a
+flight_id, always go to the same worker so they run in submission order.
+"""
+
+import queue
+import threading
+import time
+import traceback
+
+from dbg import log
+
+class KeyedDispatcher:
+    """
+    workers: number of worker threads, each with its own FIFO queue.
+    maxsize: total number of queued callbacks, split across the workers.
+    policy: what submit() does when a worker's queue is full.  "block"
+    waits for room, so nothing is lost but ingest slows to the subscriber's
+    pace.  "drop" discards the new callback and counts it.
+    """
+    POLICIES = ("block", "drop")
+
+    def __init__(self, workers=2, maxsize=10000, policy="block", name="dispatch"):
+        if policy not in self.POLICIES:
+            raise ValueError("unknown dispatch policy %s" % policy)
+        self.name = name
+        self.policy = policy
+        per_worker = max(1, maxsize // workers)
+        self.queues = [queue.Queue(per_worker) for _ in range(workers)]
+        self.stats_lock = threading.Lock()
+        self.reset()
+        self.threads = [threading.Thread(target=self.work, args=(q,), daemon=True,
+                                         name="%s-%d" % (name, k))
+                        for k, q in enumerate(self.queues)]
+        for thread in self.threads: thread.start()
+
+    def reset(self):
+        """Start a new metrics interval"""
+        self.start = time.monotonic()
+        self.submitted = 0
+        self.dispatched = 0
+        self.dropped = 0
+        self.blocked = 0
+        self.errors = 0
+        self.max_depth = 0
+        self.wait_total = 0.      # seconds queued, over dispatched callbacks
+        self.wait_max = 0.
+        self.run_total = 0.       # seconds running the callbacks
+        self.run_max = 0.
+
+    def submit(self, key, fn, *args):
+        """Queue fn(*args) behind earlier callbacks for key.  False if it was dropped."""
+        q = self.queues[hash(key) % len(self.queues)]
+        item = (time.monotonic(), fn, args)
+        try:
+            q.put_nowait(item)
+            ok = True
+        except queue.Full:
+            if self.policy == "block":
+                with self.stats_lock: self.blocked += 1
+                q.put(item)
+                ok = True
+            else:
+                ok = False
+
+        depth = q.qsize()
+        with self.stats_lock:
+            if ok: self.submitted += 1
+            else: self.dropped += 1
+            if depth > self.max_depth: self.max_depth = depth
+        return ok
+
+    def work(self, q):
+        while True:
+            item = q.get()
+            if item is None: return
+            queued, fn, args = item
+            started = time.monotonic()
+            try:
+                fn(*args)
+            except Exception:
+                with self.stats_lock: self.errors += 1
+                log("%s: callback %s failed:\n%s" %
+                    (self.name, getattr(fn, "__name__", fn), traceback.format_exc()))
+            done = time.monotonic()
+            wait = started - queued
+            run = done - started
+            with self.stats_lock:
+                self.dispatched += 1
+                self.wait_total += wait
+                self.run_total += run
+                if wait > self.wait_max: self.wait_max = wait
+                if run > self.run_max: self.run_max = run
+
+    def depth(self):
+        """Callbacks currently queued across all workers"""
+        return sum(q.qsize() for q in self.queues)
+
+    def report(self, reset=True):
+        """
+        Print this interval's metrics and start a new one.  reset=False
+        just prints them, for callers other than the one owning the
+        interval, e.g. the read loop's checkpoint.
+        """
+        with self.stats_lock:
+            elapsed = time.monotonic() - self.start
+            if self.submitted or self.dropped:
+                n = max(self.dispatched, 1)
+                print("%s: %d queued, %d max depth, %d submitted, %d dispatched, %d dropped, "
+                      "%d blocked, %d errors in %.1fs; wait %.1f avg/%.1f max ms, "
+                      "run %.1f avg/%.1f max ms" %
+                      (self.name, self.depth(), self.max_depth, self.submitted,
+                       self.dispatched, self.dropped, self.blocked, self.errors, elapsed,
+                       1000 * self.wait_total / n, 1000 * self.wait_max,
+                       1000 * self.run_total / n, 1000 * self.run_max))
+            if reset: self.reset()
+
+    def stop(self, wait=True):
+        """Run what's already queued, then end the worker threads"""
+        for q in self.queues: q.put(None)
+        if wait:
+            for thread in self.threads: thread.join()
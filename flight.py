@@ -1,20 +1,50 @@
+import array
 import dataclasses
 from dataclasses import dataclass, field, InitVar
 from typing import Optional
+import functools
+import json
 import time
-import statistics
 import collections
 import typing
 import datetime
+import sys
 import threading
 
+import numpy as np
 from geopy import distance
 import bboxes
-from dbg import dbg, log
+from dbg import dbg, log, get_dbg_level
 from icao_nnumber_converter_us import n_to_icao, icao_to_n
 from threading import Lock
 
-@dataclass
+# slotted dataclasses (python 3.10+) have no per-instance __dict__, much
+# smaller with thousands of Locations and Flights alive
+DATACLASS_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+try:
+    import orjson   # optional, much faster than the stdlib for readsb lines
+    JSON_BACKEND = "orjson"
+except ImportError:
+    orjson = None
+    JSON_BACKEND = "json"
+
+def json_loads(line):
+    """Decode a JSON line given as str, bytes or memoryview"""
+    if orjson:
+        return orjson.loads(line)
+    if isinstance(line, memoryview):
+        line = line.tobytes()
+    return json.loads(line)
+
+@functools.lru_cache(maxsize=16384)
+def tail_from_hex(hexcode):
+    """N-number for an ICAO hex code, or None.  Cached, the same few hundred
+    aircraft send many messages each."""
+    if not isinstance(hexcode, str): return None
+    return icao_to_n(hexcode)
+
+@dataclass(**DATACLASS_SLOTS)
 class Location:
     """A single aircraft position + data update """
     lat: float = 0.
@@ -34,6 +64,26 @@ class Location:
         if not isinstance(self.alt_baro, int): self.alt_baro = 0
         if not isinstance(self.gs, float): self.gs = 0
         if not isinstance(self.track, float): self.track = 0.
+        # the same few hundred ids repeat in every message
+        if isinstance(self.flight, str): self.flight = sys.intern(self.flight)
+        if isinstance(self.hex, str): self.hex = sys.intern(self.hex)
+
+    def set(self, lat, lon, alt_baro, now, flight, hex, tail, gs, track):
+        """Overwrite all fields in place, see Flights.INPLACE_LOCATIONS"""
+        self.lat = lat
+        self.lon = lon
+        self.alt_baro = alt_baro
+        self.now = now
+        self.flight = flight
+        self.hex = hex
+        self.tail = tail
+        self.gs = gs
+        self.track = track
+        self.__post_init__()
+
+    def copy(self):
+        return Location(self.lat, self.lon, self.alt_baro, self.now, self.flight,
+                        self.hex, self.tail, self.gs, self.track)
 
     @classmethod
     def from_dict(cl, d: dict):
@@ -43,7 +93,7 @@ class Location:
                 nd[f.name] = d[f.name]
         # XXX should this be in flight?
         if "hex" in d:
-            tail = icao_to_n(d["hex"])
+            tail = tail_from_hex(d["hex"])
             if tail: nd["tail"] = tail
         return Location(**nd)
 
@@ -62,7 +112,226 @@ class Location:
     def __gt__(self, other):
         return self.alt_baro > other.alt_baro
 
-@dataclass
+class LocationDecoder:
+    """
+    Fast path replacing Location.from_dict(json.loads(line)) for readsb
+    input.  Only the fields Location uses are pulled from the decoded
+    record, and records with no usable flight id are rejected before any
+    Location is built.
+
+    last_now is the timestamp of the most recent record, including rejected
+    ones: replay sends "N/A" records to move the clock when no aircraft are
+    around.
+
+    scratch: decode every record into the same Location, for callers that
+    copy out of it before the next decode (Flights.INPLACE_LOCATIONS).
+    """
+    def __init__(self, scratch=False):
+        self.last_now = None
+        self.rejected = 0
+        self.scratch = Location() if scratch else None
+
+    def decode(self, line):
+        """
+        Return a Location for line (str, bytes or memoryview), or None if
+        the record isn't usable.  Raises ValueError on invalid JSON.
+        """
+        d = json_loads(line)
+        if not isinstance(d, dict):
+            self.rejected += 1
+            return None
+        get = d.get
+        now = self.last_now = get("now", 0)
+        flight = get("flight")
+        if not flight or flight == "N/A" or not isinstance(flight, str):
+            self.rejected += 1
+            return None
+
+        hexcode = get("hex")
+        tail = get("tail")
+        if hexcode is not None:
+            tail = tail_from_hex(hexcode) or tail
+        # __post_init__ cleans up the "not available" string values
+        if self.scratch:
+            self.scratch.set(get("lat", 0.), get("lon", 0.), get("alt_baro", 0), now,
+                             flight, hexcode, tail, get("gs", 0), get("track", 0.))
+            return self.scratch
+        return Location(get("lat", 0.), get("lon", 0.), get("alt_baro", 0), now,
+                        flight, hexcode, tail, get("gs", 0), get("track", 0.))
+
+def box_names(bboxes_list, indices):
+    """Box name per KML file for a list of box indices, " " where not in one"""
+    names = []
+    for bboxes, index in zip(bboxes_list, indices):
+        boxes = bboxes.boxes
+        names.append(boxes[index].name if 0 <= index < len(boxes) else " ")
+    return names
+
+class BboxTransition:
+    """
+    A change in which bboxes a flight is inside, passed to change_cb by
+    Flight.update_inside_bboxes: box index per KML file before and after
+    (-1 for none), and the timestamp.  Names and strings are only built
+    if asked for.
+    """
+    __slots__ = ("flight", "now", "old", "new", "_old_str")
+
+    def __init__(self, flight, now, old, new, old_str=None):
+        self.flight = flight
+        self.now = now
+        self.old = old
+        self.new = new
+        self._old_str = old_str
+
+    def old_names(self):
+        return box_names(self.flight.bboxes_list, self.old)
+
+    def new_names(self):
+        return box_names(self.flight.bboxes_list, self.new)
+
+    def was_in(self, name):
+        """Was the flight in a box with name in its name?"""
+        return any(name in box for box in self.old_names())
+
+    def is_in(self, name):
+        """Is the flight now in a box with name in its name?"""
+        return any(name in box for box in self.new_names())
+
+    def to_str(self):
+        """Flight.to_str() after the change"""
+        return self.flight.lastloc.to_str() + " " + str(self.new_names())
+
+    def old_to_str(self):
+        """Flight.to_str() from before the change"""
+        if self._old_str is None:
+            self._old_str = self.flight.lastloc.to_str() + " " + str(self.old_names())
+        return self._old_str
+
+def string_change_cb(change_cb):
+    """
+    Adapt an old style change_cb(flight, flight_str, old_flight_str) to
+    take BboxTransitions.
+    """
+    if not change_cb: return None
+    def shim(transition):
+        change_cb(transition.flight, transition.to_str(), transition.old_to_str())
+    return shim
+
+class VerticalTrend(array.array):
+    """
+    Streaming least squares fit of altitude against time, O(1) per update
+    from running sums.  Older positions are discounted by a constant factor
+    per position, so the fit follows about the last window of them without
+    keeping the positions themselves.  Times are kept relative to a base
+    that's moved up now and then so the sums don't lose precision.
+
+    The state is the array's own items, one small object per flight.
+    """
+    __slots__ = ()
+    DECAY, WEIGHT, BASE, LAST, SUM_T, SUM_A, SUM_TT, SUM_TA = range(8)
+    REBASE_SECS = 600.
+
+    def __new__(cls, window):
+        self = super().__new__(cls, "d", bytes(8 * 8))
+        self[cls.DECAY] = 1. - 2. / (window + 1)
+        return self
+
+    def append(self, now, alt):
+        if not now: return
+        if not self[self.WEIGHT]: self[self.BASE] = now
+        t = now - self[self.BASE]
+        if self[self.WEIGHT] and t <= self[self.LAST]: return     # not newer
+        decay = self[self.DECAY]
+        self[self.WEIGHT] = self[self.WEIGHT] * decay + 1.
+        self[self.SUM_T] = self[self.SUM_T] * decay + t
+        self[self.SUM_A] = self[self.SUM_A] * decay + alt
+        self[self.SUM_TT] = self[self.SUM_TT] * decay + t * t
+        self[self.SUM_TA] = self[self.SUM_TA] * decay + t * alt
+        self[self.LAST] = t
+        if t > self.REBASE_SECS: self.rebase()
+
+    def rebase(self):
+        """Move base up to the weighted mean time, shifting the sums to match"""
+        weight = self[self.WEIGHT]
+        sum_t = self[self.SUM_T]
+        shift = sum_t / weight
+        self[self.BASE] += shift
+        self[self.LAST] -= shift
+        self[self.SUM_TT] += shift * (weight * shift - 2 * sum_t)
+        self[self.SUM_TA] -= shift * self[self.SUM_A]
+        self[self.SUM_T] = 0.
+
+    def rate(self):
+        """Climb rate in feet/sec, 0 until there are two positions"""
+        n = self[self.WEIGHT]
+        sum_t = self[self.SUM_T]
+        denom = n * self[self.SUM_TT] - sum_t * sum_t
+        if n <= 1. or denom <= 1e-9: return 0.
+        return (n * self[self.SUM_TA] - sum_t * self[self.SUM_A]) / denom
+
+    def fpm(self):
+        """Climb rate in feet/minute"""
+        return self.rate() * 60.
+
+    def altitude(self):
+        """Smoothed altitude: the fitted line at the latest position"""
+        n = self[self.WEIGHT]
+        if not n: return 0.
+        mean_t = self[self.SUM_T] / n
+        return self[self.SUM_A] / n + self.rate() * (self[self.LAST] - mean_t)
+
+class TrackHistory:
+    """
+    Recent positions of one flight in a fixed size ring buffer, rows of
+    FIELDS in a preallocated array.  Positions less than interval seconds
+    after the last one kept are dropped.  Once full the oldest rows are
+    overwritten.
+    """
+    FIELDS = ("now", "lat", "lon", "alt_baro", "gs", "track")
+    __slots__ = ("data", "start", "count", "interval", "last_time")
+
+    def __init__(self, depth, interval=0.):
+        self.data = np.zeros((depth, len(self.FIELDS)), dtype=np.float64)
+        self.start = 0      # row of the oldest position
+        self.count = 0
+        self.interval = interval
+        self.last_time = None
+
+    def __len__(self):
+        return self.count
+
+    def append(self, loc):
+        """Add loc unless it's too soon after the last one, returns True if added"""
+        now = loc.now or 0
+        if self.last_time is not None and now - self.last_time < self.interval:
+            return False
+        self.last_time = now
+        depth = len(self.data)
+        if self.count < depth:
+            row = (self.start + self.count) % depth
+            self.count += 1
+        else:
+            row = self.start
+            self.start = (self.start + 1) % depth
+        self.data[row] = (now, loc.lat, loc.lon, loc.alt_baro, loc.gs, loc.track)
+        return True
+
+    def segments(self):
+        """
+        The history oldest first, as one or two views into the buffer (no
+        copying).  Only valid until the next append.
+        """
+        end = self.start + self.count
+        if end <= len(self.data):
+            return [self.data[self.start:end]]
+        return [self.data[self.start:], self.data[:end - len(self.data)]]
+
+    def column(self, field):
+        """One of FIELDS over the whole history, oldest first, as a new array"""
+        k = self.FIELDS.index(field)
+        return np.concatenate([segment[:, k] for segment in self.segments()])
+
+@dataclass(**DATACLASS_SLOTS)
 class Flight:
     """Summary of a series of locations, plus other annotations"""
     # Caution when changing: ctor positional args implied
@@ -72,14 +341,38 @@ class Flight:
     lastloc: Location
     bboxes_list: list = field(default_factory=list)
     external_id: str = None # optional, database id for this flight
-    alt_list: list = field(default_factory=list)  # last n altitudes we've seen
     inside_bboxes: list = field(default_factory=list)  # most recent bboxes we've been inside, by file
-    threadlock: Lock = field(default_factory=Lock)
-    flags: dict = field(default_factory=lambda: ({}))
-    ALT_TRACK_ENTRIES = 5
+    bbox_cache: list = field(default_factory=list)  # ContainsResult per file, to skip geometry
+    trend: Optional[VerticalTrend] = None   # climb rate and smoothed altitude
+    history: Optional[TrackHistory] = None  # recent positions once in a bbox, see HISTORY_DEPTH
+    # most flights never need these, see the threadlock and flags properties
+    _threadlock: Optional[Lock] = field(default=None, init=False, repr=False, compare=False)
+    _flags: Optional[dict] = field(default=None, init=False, repr=False, compare=False)
+    ALT_TRACK_ENTRIES = 8   # about this many positions in the VerticalTrend fit
+    LEVEL_FPM = 100     # climb rates under this show as level
+    HISTORY_DEPTH = 60  # positions kept in history, 0 for none
+    HISTORY_INTERVAL = 5.   # seconds between positions kept in history
+    CREATE_LOCK = Lock()    # guards lazy creation of threadlock
 
     def __post_init__(self):
         self.inside_bboxes = [-1] * len(self.bboxes_list)
+        self.bbox_cache = [None] * len(self.bboxes_list)
+        if isinstance(self.flight_id, str): self.flight_id = sys.intern(self.flight_id)
+        if self.trend is None:
+            self.trend = VerticalTrend(self.ALT_TRACK_ENTRIES)
+            if self.lastloc: self.trend.append(self.lastloc.now, self.lastloc.alt_baro)
+
+    @property
+    def threadlock(self):
+        if self._threadlock is None:
+            with Flight.CREATE_LOCK:
+                if self._threadlock is None: self._threadlock = Lock()
+        return self._threadlock
+
+    @property
+    def flags(self):
+        if self._flags is None: self._flags = {}
+        return self._flags
 
     def to_str(self):
         """
@@ -107,20 +400,19 @@ class Flight:
             if index >= 0: return True
         return False
 
-    def track_alt(self, alt):
-        avg = alt
-        if len(self.alt_list):
-            avg = statistics.fmean(self.alt_list)
-        if len(self.alt_list) == self.ALT_TRACK_ENTRIES:
-            self.alt_list.pop(0)
-        self.alt_list.append(alt)
-
-        avg = int(avg)
-        if alt > avg: return 1
-        if alt < avg: return -1
+    @property
+    def vrate(self):
+        """Climb rate in feet/sec"""
+        return self.trend.rate()
+
+    def track_alt(self, alt=None):
+        """1 if climbing, -1 if descending, 0 if level.  alt is unused, see update_loc()"""
+        fpm = self.trend.fpm()
+        if fpm >= self.LEVEL_FPM: return 1
+        if fpm <= -self.LEVEL_FPM: return -1
         return 0
 
-    def get_alt_change_str(self, alt):
+    def get_alt_change_str(self, alt=None):
         altchange = self.track_alt(alt)
         altchangestr = "  "
         if altchange > 0:
@@ -129,33 +421,55 @@ class Flight:
             altchangestr = "v"
         return altchangestr
 
-    def update_loc(self, loc):
-        self.lastloc = loc
+    def update_loc(self, loc, in_place=False):
+        """in_place: copy loc into lastloc rather than keeping loc itself"""
+        self.trend.append(loc.now, loc.alt_baro)
+        if self.history is not None: self.history.append(loc)
+        if in_place:
+            self.lastloc.set(loc.lat, loc.lon, loc.alt_baro, loc.now, loc.flight,
+                             loc.hex, loc.tail, loc.gs, loc.track)
+        else:
+            self.lastloc = loc
 
-    def update_inside_bboxes(self, bbox_list, loc, change_cb):
+    def update_inside_bboxes(self, bbox_list, loc, change_cb, indices=None, old_str=None):
         """
         Array indices in here are all per kml file.
+        change_cb: called with a BboxTransition if any box changed.
+        Returns the BboxTransition, or None if no box changed.
+        indices: optional precomputed box index per kml file for loc,
+        from bboxes.contains_many_layers().
+        old_str: to_str() from before a KML reload, for the BboxTransition
         """
-        changes = False
-        old_str = self.to_str()
+        old = None
         for i, bbox in enumerate(bbox_list):
-            new_bbox = bbox_list[i].contains(loc.lat, loc.lon, loc.track, loc.alt_baro)
+            if indices is not None:
+                new_bbox = indices[i]
+            else:
+                cached = self.bbox_cache[i] = bbox.contains_cached(loc.lat, loc.lon,
+                    loc.track, loc.alt_baro, loc.now, loc.gs, self.bbox_cache[i])
+                new_bbox = cached.box
             if self.inside_bboxes[i] != new_bbox:
-                changes = True
+                if old is None: old = list(self.inside_bboxes)
                 self.inside_bboxes[i] = new_bbox
 
-        if changes:
+        if old is None: return None
+        # most traffic never enters a bbox, so only pay for history when it does
+        if self.history is None and self.HISTORY_DEPTH and self.in_any_bbox():
+            self.history = TrackHistory(self.HISTORY_DEPTH, self.HISTORY_INTERVAL)
+            self.history.append(self.lastloc)
+        if get_dbg_level() > 0:
             flighttime = datetime.datetime.fromtimestamp(self.lastloc.now)
-            dt = datetime.datetime.today()
             tail = self.tail if self.tail else "(unk)"
             log(tail + " Flight bbox change at " + flighttime.strftime("%H:%M") +
                 ": " + self.to_str())
-            if change_cb: change_cb(self, self.to_str(), old_str)
+        transition = BboxTransition(self, loc.now, old, list(self.inside_bboxes), old_str)
+        if change_cb: change_cb(transition)
+        return transition
 
     def get_bbox_at_level(self, level, bboxes_list):
         inside_n = self.inside_bboxes[level]
-        if inside_n >= 0:
-            bboxes = bboxes_list[level]
-            return bboxes.boxes[inside_n]
+        boxes = bboxes_list[level].boxes
+        if inside_n >= 0 and inside_n < len(boxes):  # may be mid KML reload
+            return boxes[inside_n]
         else:
             return None
@@ -0,0 +1,98 @@
+"""
+Columnar copy of the per-flight state the Flights checkpoint passes need,
+so conflict candidate selection is a single numpy pass rather
+than Python loops over flight_dict.  Flight objects stay the real state,
+Flights writes every update through to the table.
+"""
+
+import numpy as np
+
+COLUMNS = ("lat", "lon", "alt_baro", "gs", "track", "now", "vrate")
+
+def flight_columns(flights):
+    """COLUMNS of a list of Flights as a dict of arrays, like FlightTable.select()"""
+    locs = [flight.lastloc for flight in flights]
+    columns = {name: np.array([getattr(loc, name) for loc in locs], dtype=np.float64)
+               for name in COLUMNS if name != "vrate"}
+    columns["vrate"] = np.array([flight.vrate for flight in flights], dtype=np.float64)
+    return columns
+
+class FlightTable:
+    """
+    One row (slot) per tracked flight: COLUMNS, then the box index per KML
+    layer, all float64 so a row is written in one go.  Freed slots are
+    reused, so rows also record an insertion serial number to recover
+    flight_dict order.
+    """
+    INITIAL_SLOTS = 256
+
+    def __init__(self, layers):
+        self.layers = layers
+        self.slots = {}         # flight_id: slot
+        self.flights = []       # Flight by slot, None if free
+        self.free = []
+        self.serial = 0
+        self.resize(self.INITIAL_SLOTS)
+
+    def resize(self, n):
+        old = len(self.flights)
+        data = np.zeros((n, len(COLUMNS) + self.layers), dtype=np.float64)
+        order = np.zeros(n, dtype=np.int64)
+        used = np.zeros(n, dtype=bool)
+        if old:
+            data[:old] = self.data
+            order[:old] = self.order
+            used[:old] = self.used
+        self.data = data
+        self.order = order
+        self.used = used
+        self.columns = {name: data[:, k] for k, name in enumerate(COLUMNS)}
+        self.boxes = data[:, len(COLUMNS):]
+        self.free.extend(range(n - 1, old - 1, -1))
+        self.flights.extend([None] * (n - old))
+
+    def __len__(self):
+        return len(self.slots)
+
+    def add(self, flight):
+        if not self.free: self.resize(len(self.flights) * 2)
+        slot = self.free.pop()
+        self.slots[flight.flight_id] = slot
+        self.flights[slot] = flight
+        self.used[slot] = True
+        self.order[slot] = self.serial
+        self.serial += 1
+        self.update(flight, slot)
+        return slot
+
+    def remove(self, flight_id):
+        slot = self.slots.pop(flight_id)
+        self.flights[slot] = None
+        self.used[slot] = False
+        self.free.append(slot)
+
+    def update(self, flight, slot=None):
+        """Write flight's current state through to its row"""
+        if slot is None: slot = self.slots[flight.flight_id]
+        loc = flight.lastloc
+        self.data[slot] = (loc.lat, loc.lon, loc.alt_baro, loc.gs, loc.track, loc.now or 0,
+                           flight.vrate, *flight.inside_bboxes)
+
+    def ordered(self, mask):
+        """Slots where mask is set, in flight_dict order"""
+        slots = np.flatnonzero(mask & self.used)
+        return slots[np.argsort(self.order[slots], kind="stable")]
+
+    def candidates(self, last_read_time, max_age, min_alt):
+        """
+        Flights in any bbox, seen within max_age of last_read_time and at or
+        above min_alt, in flight_dict order, plus their columns.
+        """
+        columns = self.columns
+        mask = ((self.boxes >= 0).any(axis=1) & (last_read_time - columns["now"] <= max_age) &
+                (columns["alt_baro"] >= min_alt))
+        slots = self.ordered(mask)
+        return [self.flights[slot] for slot in slots.tolist()], self.select(slots)
+
+    def select(self, slots):
+        return {name: column[slots] for name, column in self.columns.items()}
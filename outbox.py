@@ -0,0 +1,312 @@
+"""
+Durable queue of AppSheet writes.  Appsheet.add_op/add_cpe/update_cpe
+store their row in a local SQLite database (WAL mode, so a write is a
+short append) and return at once.  A drainer thread sends the rows in
+batches and keeps going from where it stopped after a restart.
+
+Every row carries its outbox key in KEY_COLUMN.  If a send failed in a way
+that might have reached AppSheet anyway (timeout, dropped connection), the
+table is searched for those keys before sending again, so rows aren't
+added twice.  So is an Add whose reply doesn't give back its Row ID, and
+edits of it wait until the lookup finds it.  The AppSheet tables need a
+text column of that name.
+
+Each table and action backs off on its own, so an outage of one table
+doesn't hold up the others.  AppSheet refusing a batch (a 4xx) is not
+retried: its rows are sent one at a time so only the ones refused fail.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+import requests
+
+from dbg import dbg, log
+
+KEY_PREFIX = "outbox-"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT UNIQUE NOT NULL,
+    tbl TEXT NOT NULL,          -- AppSheet table, private.yaml has its <tbl>_url
+    action TEXT NOT NULL,       -- Add or Edit
+    row TEXT NOT NULL,          -- JSON
+    depends TEXT,               -- key of the entry whose Row ID this row edits
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    uncertain INTEGER NOT NULL DEFAULT 0,   -- a failed send may have gone through
+    state INTEGER NOT NULL DEFAULT 0,       -- PENDING, SENT or FAILED
+    row_id TEXT                 -- AppSheet's Row ID once sent
+)
+"""
+
+PENDING, SENT, FAILED = 0, 1, 2
+
+def permanent(error):
+    """Would sending the same rows again fail the same way?"""
+    status = getattr(error, "status_code", None)   # appsheet_api.AppsheetError
+    return status is not None and status < 500 and status not in (408, 429)
+
+def is_key(value):
+    """Is value an outbox key, rather than an AppSheet Row ID?"""
+    return isinstance(value, str) and value.startswith(KEY_PREFIX)
+
+class Outbox:
+    KEY_COLUMN = "Outbox Key"
+    BATCH_ROWS = 20
+    MAX_ATTEMPTS = 20       # then the entry is given up on and logged
+    BACKOFF_SECS = 2.       # after a failed batch, doubling, per table and action
+    BACKOFF_MAX_SECS = 120.
+    KEEP_SECS = 24*60*60    # sent entries are kept this long for update_cpe to refer to
+
+    def __init__(self, path, appsheet):
+        self.appsheet = appsheet
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")    # survives process restarts, not power loss
+        self.db.execute(SCHEMA)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.backoff = {}         # (tbl, action): seconds, doubling while sends fail
+        self.next_attempt = {}    # (tbl, action): time.monotonic() before which it isn't sent
+        self.last_prune = 0
+        self.sent = 0
+        self.failed_batches = 0
+        self.given_up = 0
+        self.singly = set()       # keys from refused batches, sent on their own until done
+        pending = self.pending()
+        if pending: log("Outbox %s: resuming with %d unsent entries" % (path, pending))
+        self.thread = threading.Thread(target=self.drain_loop, daemon=True, name="outbox")
+        self.thread.start()
+
+    def put(self, tbl, action, row, depends=None):
+        """Queue row for tbl, returns its outbox key"""
+        key = KEY_PREFIX + uuid.uuid4().hex
+        if self.KEY_COLUMN: row = dict(row, **{self.KEY_COLUMN: key})
+        with self.lock:
+            self.db.execute("INSERT INTO outbox (key, tbl, action, row, depends, created) "
+                            "VALUES (?, ?, ?, ?, ?, ?)",
+                            (key, tbl, action, json.dumps(row), depends, time.time()))
+        self.wakeup.set()
+        return key
+
+    def pending(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM outbox WHERE state = ?",
+                                   (PENDING,)).fetchone()[0]
+
+    def report(self):
+        with self.lock:
+            pending, oldest = self.db.execute(
+                "SELECT COUNT(*), MIN(created) FROM outbox WHERE state = ?", (PENDING,)).fetchone()
+        age = time.time() - oldest if oldest else 0
+        return ("Outbox: %d pending, oldest %.0fs, %d sent, %d failed batches, %d given up" %
+                (pending, age, self.sent, self.failed_batches, self.given_up))
+
+    def held(self, now=None):
+        """(tbl, action) groups still backing off"""
+        now = time.monotonic() if now is None else now
+        return [group for group, until in self.next_attempt.items() if until > now]
+
+    def drain_loop(self):
+        while not self.stopped:
+            self.wakeup.clear()
+            try:
+                progress = self.drain()
+            except Exception as e:
+                log("Outbox drain error: " + str(e))
+                time.sleep(self.BACKOFF_SECS)
+                continue
+            if progress: continue
+            # sleep until the first backoff ends or put() queues something;
+            # drain() leaves groups that are backing off alone either way
+            now = time.monotonic()
+            wait = min([until - now for until in self.next_attempt.values() if until > now],
+                       default=self.BACKOFF_MAX_SECS)
+            self.wakeup.wait(min(wait, self.BACKOFF_MAX_SECS))
+
+    def drain(self):
+        """
+        Send one round of pending entries, oldest first, batched by table
+        and action, skipping groups that are backing off.  Returns True if
+        any entry was sent or given up on.
+        """
+        held = self.held()
+        with self.lock:
+            entries = self.db.execute(
+                "SELECT o.key, o.tbl, o.action, o.row, o.depends, o.uncertain, o.attempts, "
+                "d.state, d.row_id FROM outbox o LEFT JOIN outbox d ON d.key = o.depends "
+                "WHERE o.state = ?" + " AND NOT (o.tbl = ? AND o.action = ?)" * len(held) +
+                " ORDER BY o.id LIMIT ?",
+                (PENDING, *(value for group in held for value in group),
+                 self.BATCH_ROWS * 4)).fetchall()
+        self.prune()
+
+        groups = {}     # (tbl, action): [(key, row, uncertain, attempts)], in order of first entry
+        orphans = []
+        for key, tbl, action, row, depends, uncertain, attempts, dep_state, dep_row_id in entries:
+            row = json.loads(row)
+            if depends:
+                if dep_state == PENDING: continue   # wait for the add it edits
+                if dep_state != SENT or not dep_row_id:
+                    orphans.append(key)
+                    continue
+                row["Row ID"] = dep_row_id
+            group = groups.setdefault((tbl, action), [])
+            if len(group) < self.BATCH_ROWS: group.append((key, row, uncertain, attempts))
+
+        if orphans:
+            log("Outbox giving up on %d entries whose add failed or has no Row ID" %
+                len(orphans))
+            self.given_up += len(orphans)
+            with self.lock:
+                self.db.executemany("UPDATE outbox SET state = ? WHERE key = ?",
+                                    [(FAILED, key) for key in orphans])
+
+        progress = bool(orphans)
+        for (tbl, action), group in groups.items():
+            if self.send(tbl, action, group): progress = True
+        return progress
+
+    def send(self, tbl, action, group):
+        suspects = [entry for entry in group if entry[0] in self.singly]
+        if suspects and len(group) > 1:
+            rest = [entry for entry in group if entry[0] not in self.singly]
+            progress = self.send_singly(tbl, action, suspects)
+            if rest and (tbl, action) not in self.held():
+                if self.send(tbl, action, rest): progress = True
+            return progress
+
+        if action == "Add" and self.KEY_COLUMN and any(uncertain for _, _, uncertain, _ in group):
+            try:
+                group = self.skip_delivered(tbl, group)
+            except Exception as e:
+                self.failed(tbl, action, group, False, e)
+                return False
+            if not group: return True
+
+        keys = [key for key, _, _, _ in group]
+        try:
+            # no retrying inside the call, a timed out Add has to be looked
+            # for before it's sent again
+            returned = self.appsheet.send_rows(tbl, action, [row for _, row, _, _ in group],
+                                               retries=0)
+        except Exception as e:
+            if not permanent(e):
+                uncertain = isinstance(e, (requests.Timeout, requests.ConnectionError))
+                self.failed(tbl, action, group, uncertain, e)
+                return False
+            if len(group) == 1:
+                self.give_up(group, e)
+                return True
+            # one bad row fails the whole call, send them singly to find it
+            log("Outbox %s %s of %d rows refused, sending them one at a time: %s" %
+                (tbl, action, len(group), e))
+            self.singly.update(keys)
+            return self.send_singly(tbl, action, group)
+
+        row_ids = self.row_ids(group, returned)
+        if action == "Add":
+            # an add whose Row ID didn't come back may or may not have gone
+            # in, it's looked up by key before it's sent again
+            unknown = [entry for entry, row_id in zip(group, row_ids) if not row_id]
+            sent = [(key, row_id) for key, row_id in zip(keys, row_ids) if row_id]
+        else:
+            unknown = []
+            sent = [(key, row_id or row.get("Row ID"))
+                    for (key, row, _, _), row_id in zip(group, row_ids)]
+        self.mark_sent(sent)
+        self.backoff.pop((tbl, action), None)
+        dbg("Outbox sent %d %s %s rows" % (len(sent), tbl, action))
+        if unknown:
+            self.failed(tbl, action, unknown, True, "reply had no Row ID for %d of %d rows" %
+                        (len(unknown), len(group)))
+        return bool(sent)
+
+    def row_ids(self, group, returned):
+        """Row ID AppSheet returned for each entry of group, None where the reply doesn't say"""
+        returned = [row if isinstance(row, dict) else {} for row in returned]
+        by_key = {row[self.KEY_COLUMN]: row.get("Row ID") for row in returned
+                  if self.KEY_COLUMN and row.get(self.KEY_COLUMN)}
+        if by_key: return [by_key.get(key) for key, _, _, _ in group]
+        if len(returned) != len(group): return [None] * len(group)
+        return [row.get("Row ID") for row in returned]
+
+    def send_singly(self, tbl, action, group):
+        """Send each entry on its own, until one fails and (tbl, action) backs off"""
+        progress = False
+        for entry in group:
+            if self.send(tbl, action, [entry]): progress = True
+            if (tbl, action) in self.held(): break
+        return progress
+
+    def skip_delivered(self, tbl, group):
+        """Mark entries already in tbl as sent, return the rest of group"""
+        # just the rows with these keys, not the whole table
+        selector = 'Filter(%s, IN([%s], LIST(%s)))' % (
+            self.appsheet.table_name(tbl), self.KEY_COLUMN,
+            ", ".join('"%s"' % key for key, _, _, _ in group))
+        found = {}
+        for row in self.appsheet.find_all(tbl, selector):
+            if isinstance(row, dict) and row.get(self.KEY_COLUMN):
+                found[row[self.KEY_COLUMN]] = row.get("Row ID")
+        self.mark_sent([(key, found[key]) for key, _, _, _ in group if key in found])
+        return [entry for entry in group if entry[0] not in found]
+
+    def mark_sent(self, sent):
+        if not sent: return
+        with self.lock:
+            self.db.executemany("UPDATE outbox SET state = ?, row_id = ? WHERE key = ?",
+                                [(SENT, row_id, key) for key, row_id in sent])
+        self.sent += len(sent)
+        self.singly.difference_update(key for key, _ in sent)
+
+    def give_up(self, group, error):
+        """AppSheet refused these entries, sending them again won't help"""
+        log("Outbox giving up on %s: %s" % (", ".join(key for key, _, _, _ in group), error))
+        self.given_up += len(group)
+        self.singly.difference_update(key for key, _, _, _ in group)
+        with self.lock:
+            self.db.executemany("UPDATE outbox SET state = ? WHERE key = ?",
+                                [(FAILED, key) for key, _, _, _ in group])
+
+    def failed(self, tbl, action, group, uncertain, error):
+        self.failed_batches += 1
+        backoff = min(self.BACKOFF_MAX_SECS,
+                      max(self.BACKOFF_SECS, self.backoff.get((tbl, action), 0) * 2))
+        self.backoff[(tbl, action)] = backoff
+        self.next_attempt[(tbl, action)] = time.monotonic() + backoff
+        log("Outbox %s %s of %d rows failed, retrying in %.1fs: %s" %
+            (tbl, action, len(group), backoff, error))
+        with self.lock:
+            for key, _, was_uncertain, attempts in group:
+                state = PENDING
+                if attempts + 1 >= self.MAX_ATTEMPTS:
+                    state = FAILED
+                    self.given_up += 1
+                    self.singly.discard(key)
+                    log("Outbox giving up on %s" % key)
+                self.db.execute("UPDATE outbox SET attempts = ?, uncertain = ?, state = ? "
+                                "WHERE key = ?",
+                                (attempts + 1, int(uncertain or was_uncertain), state, key))
+
+    def prune(self):
+        now = time.time()
+        if now - self.last_prune < 60*60: return
+        self.last_prune = now
+        with self.lock:
+            self.db.execute("DELETE FROM outbox WHERE state != ? AND created < ?",
+                            (PENDING, now - self.KEEP_SECS))
+
+    def close(self):
+        """Stop the drainer, anything unsent is picked up on the next start"""
+        self.stopped = True
+        self.wakeup.set()
+        self.thread.join()
+        with self.lock:
+            self.db.close()
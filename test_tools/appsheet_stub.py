@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+# Local stand-in for the AppSheet API, for exercising appsheet_api.py's
+# session pooling, retries and batching without touching the real app.
+# Keeps rows in memory per URL path and answers Add/Edit/Find/Delete like
+# AppSheet does, optionally slowly, with 503s, or applying a request and
+# then dropping the connection without replying, like a reply lost on the
+# way back.  With --bad-row-rate some outbox rows are refused with a 400
+# every time they're sent, failing the whole call they're in.  Finds honour
+# the outbox's key lookup selector, other selectors are ignored.
+#
+# Usage: appsheet_stub.py [--port 8642] [--fail-rate .2] [--delay .05] [--lost-reply-rate .1]
+#                         [--bad-row-rate .05]
+# then point the *_url entries in private.yaml at http://localhost:8642/<table>
+#
+# Or drive an Appsheet client against an in-process stub and print its
+# latency histograms:  appsheet_stub.py --demo 200 --fail-rate .1
+# With --outbox the ops go through a durable outbox, which shouldn't store
+# any op twice however many replies are lost:
+#   appsheet_stub.py --demo 50 --lost-reply-rate .3 --outbox /tmp/outbox.db
+# and with bad rows, only those should be missing:
+#   appsheet_stub.py --demo 200 --bad-row-rate .05 --outbox /tmp/outbox.db
+
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, "..")
+
+KEY_COLUMN = "Outbox Key"
+KEY_SELECTOR = re.compile(r'IN\(\[([^\]]+)\], LIST\(([^)]*)\)\)')
+
+def bad_row(server, row):
+    """Is row one the stub always refuses?  Decided by its outbox key"""
+    key = row.get(KEY_COLUMN)
+    return bool(key) and zlib.crc32(key.encode()) % 1000 < server.bad_row_rate * 1000
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive, like the real API
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length))
+        if server.delay: time.sleep(random.uniform(0, 2 * server.delay))
+        with server.lock:
+            server.requests += 1
+            if random.random() < server.fail_rate:
+                server.failures += 1
+                return self.reply(503, b"")
+            table = server.tables.setdefault(self.path, {})
+            action = body.get("Action")
+            rows = body.get("Rows", [])
+            if action in ("Add", "Edit") and any(bad_row(server, row) for row in rows):
+                server.refused += 1
+                return self.reply(400, b'{"Message": "bad row"}')
+            if action == "Add":
+                result = []
+                for row in rows:
+                    server.next_id += 1
+                    row = dict(row, **{"Row ID": "stub%06d" % server.next_id})
+                    table[row["Row ID"]] = row
+                    result.append(row)
+                result = {"Rows": result}
+            elif action == "Edit":
+                for row in rows: table.setdefault(row["Row ID"], {}).update(row)
+                result = {"Rows": [table[row["Row ID"]] for row in rows]}
+            elif action == "Delete":
+                for row in rows: table.pop(row["Row ID"], None)
+                result = {"Rows": rows}
+            else:   # Find
+                server.finds += 1
+                result = list(table.values())
+                match = KEY_SELECTOR.search(body.get("Properties", {}).get("Selector", ""))
+                if match:
+                    keys = set(re.findall(r'"([^"]*)"', match.group(2)))
+                    result = [row for row in result if row.get(match.group(1)) in keys]
+                server.found_rows += len(result)
+            if action != "Find" and random.random() < server.lost_reply_rate:
+                server.lost_replies += 1
+                self.close_connection = True
+                return
+        self.reply(200, json.dumps(result).encode())
+
+    def reply(self, code, data):
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def make_server(port, fail_rate=0., delay=0., lost_reply_rate=0., bad_row_rate=0.):
+    server = ThreadingHTTPServer(("localhost", port), StubHandler)
+    server.fail_rate = fail_rate
+    server.delay = delay
+    server.lost_reply_rate = lost_reply_rate
+    server.bad_row_rate = bad_row_rate
+    server.lock = threading.Lock()
+    server.tables = {}
+    server.next_id = 0
+    server.requests = 0
+    server.failures = 0
+    server.lost_replies = 0
+    server.refused = 0
+    server.finds = 0
+    server.found_rows = 0
+    return server
+
+class StubConfig:
+    """Stands in for config.Config, pointing every table at the stub"""
+    def __init__(self, port):
+        base = "http://localhost:%d/" % port
+        self.vars = {}
+        self.private_vars = {"appsheet": {"accesskey": "stub",
+            **{table + "_url": base + table for table in
+               ("aircraft", "ops", "cpe", "pilot", "notes")}}}
+
+def demo(server, n_ops, workers, batch_window, outbox_path=None):
+    import appsheet_api
+    appsheet_api.SEND_AIRCRAFT = appsheet_api.SEND_OPS = appsheet_api.SEND_CPES = True
+    appsheet_api.Appsheet.BACKOFF_SECS = .05
+    client = appsheet_api.Appsheet(StubConfig(server.server_address[1]))
+    if batch_window: client.enable_batching(window=batch_window)
+    if outbox_path:
+        import outbox
+        outbox.Outbox.BACKOFF_SECS = .05
+        client.enable_outbox(outbox_path)
+
+    aircraft = client.add_aircraft("N123XX")
+    def work(k):
+        for i in range(k, n_ops, workers):
+            if not client.add_op(aircraft, time.time(), False, "Takeoff", "N123XX"):
+                print("op %d failed" % i)
+    start = time.time()
+    threads = [threading.Thread(target=work, args=(k,)) for k in range(workers)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    while client.outbox and client.outbox.pending(): time.sleep(.05)
+    if client.outbox: print(client.outbox.report())
+    client.close()
+    elapsed = time.time() - start
+
+    ops = len(server.tables.get("/ops", {}))
+    bad = sum(1 for row in server.tables.get("/ops", {}).values() if bad_row(server, row))
+    print("%d ops in %.2fs, %d stored (%d bad), %d requests, %d 503s, %d 400s, %d lost replies" %
+          (n_ops, elapsed, ops, bad, server.requests, server.failures, server.refused,
+           server.lost_replies))
+    print("%d finds returned %d rows" % (server.finds, server.found_rows))
+    for line in client.latency_report(): print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="local AppSheet API stub")
+    parser.add_argument("--port", type=int, default=8642)
+    parser.add_argument("--fail-rate", type=float, default=0., help="fraction of requests to 503")
+    parser.add_argument("--delay", type=float, default=0., help="average seconds per request")
+    parser.add_argument("--lost-reply-rate", type=float, default=0.,
+                        help="fraction of adds/edits applied but not answered")
+    parser.add_argument("--bad-row-rate", type=float, default=0.,
+                        help="fraction of outbox rows always refused with a 400")
+    parser.add_argument("--demo", type=int, help="send this many ops from an in-process client")
+    parser.add_argument("--workers", type=int, default=4, help="client threads for --demo")
+    parser.add_argument("--batch-window", type=float, default=0, help="client batching for --demo")
+    parser.add_argument("--outbox", help="client outbox database for --demo")
+    args = parser.parse_args()
+
+    server = make_server(0 if args.demo else args.port, args.fail_rate, args.delay,
+                         args.lost_reply_rate, args.bad_row_rate)
+    if not args.demo:
+        print("AppSheet stub on port %d" % args.port)
+        server.serve_forever()
+        return
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    demo(server, args.demo, args.workers, args.batch_window, args.outbox)
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
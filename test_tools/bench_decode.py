@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+# Micro-benchmark: LocationDecoder vs. Location.from_dict(json.loads()) on
+# recorded readsb JSON lines.
+#
+# Record some input with e.g.:  nc <readsb host> <port> | head -100000 > lines.json
+# Usage: bench_decode.py [lines.json]    (synthetic lines are used if no file given)
+
+import json
+import random
+import sys
+import time
+
+sys.path.insert(0, "..")
+import flight
+from flight import Location, LocationDecoder
+
+SYNTHETIC_LINES = 50000
+REPEAT = 3
+
+def synthetic_lines(n):
+    """readsb-like position records, with the extra fields readsb sends"""
+    lines = []
+    for i in range(n):
+        hexcode = "a%05x" % random.randint(0, 0xfffff)
+        d = {"now": 1692547200.0 + i * .01, "hex": hexcode, "type": "adsb_icao",
+             "flight": random.choice(["N%dAB    " % (i % 500), "SWA%d  " % (i % 300), "N/A"]),
+             "alt_baro": random.choice([random.randint(0, 12000), "ground"]),
+             "alt_geom": random.randint(0, 12000), "gs": random.uniform(0, 250),
+             "track": random.uniform(0, 360), "baro_rate": random.randint(-1000, 1000),
+             "squawk": "1200", "emergency": "none", "category": "A1",
+             "nav_qnh": 1013.6, "lat": random.uniform(37, 38), "lon": random.uniform(-123, -121),
+             "nic": 8, "rc": 186, "seen_pos": 0.1, "version": 2, "nic_baro": 1,
+             "nac_p": 9, "nac_v": 1, "sil": 3, "sil_type": "perhour", "gva": 2, "sda": 2,
+             "mlat": [], "tisb": [], "messages": random.randint(1, 100000),
+             "seen": 0.1, "rssi": -20.5}
+        lines.append(json.dumps(d))
+    return lines
+
+def old_path(line):
+    loc = Location.from_dict(json.loads(line))
+    if not loc.flight or loc.flight == "N/A": return None
+    return loc
+
+def bench(name, fn, lines):
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        for line in lines:
+            fn(line)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("%-28s %8.2f us/line  %9.0f lines/sec" %
+          (name, best / len(lines) * 1e6, len(lines) / best))
+    return best
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "rb") as f:
+            lines = [l for l in f.read().split(b"\n") if l.strip()]
+    else:
+        lines = [l.encode() for l in synthetic_lines(SYNTHETIC_LINES)]
+
+    decoder = LocationDecoder()
+    # results must match the old path before timing means anything
+    for line in lines:
+        try:
+            expected = old_path(line)
+        except Exception:
+            continue
+        assert decoder.decode(line) == expected, line
+
+    print("%d lines, JSON backend: %s" % (len(lines), flight.JSON_BACKEND))
+    old = bench("from_dict(json.loads())", old_path, lines)
+    new = bench("LocationDecoder.decode()", decoder.decode, lines)
+    views = [memoryview(l) for l in lines]
+    bench("decode() on memoryviews", decoder.decode, views)
+    print("speedup: %.2fx" % (old / new))
+
+if __name__ == "__main__":
+    main()
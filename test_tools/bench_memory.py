@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+# Memory benchmark: bytes retained per tracked aircraft by Flights, fed
+# through add_location() against real KML layers, so the per-layer
+# containment cache, vertical trend, track history and expiry heap are all
+# counted.  Compared against the old __dict__ based dataclasses, which kept
+# just the last Location and one box index per layer.
+#
+# Aircraft wander around the first KML's gates, so some end up inside one
+# and get a track history.
+#
+# Usage: bench_memory.py [aircraft] [updates per aircraft] [kml ...]
+# (default KMLs: ../sample_kml/sjc.kml ../sample_kml/valley.kml)
+
+import gc
+import math
+import random
+import sys
+import tracemalloc
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Optional
+
+sys.path.insert(0, "..")
+from adsb_receiver import Flights
+from bboxes import Bboxes
+from flight import Flight, Location
+
+DEFAULT_KMLS = ["../sample_kml/sjc.kml", "../sample_kml/valley.kml"]
+
+@dataclass
+class OldLocation:
+    lat: float = 0.
+    lon: float = 0.
+    alt_baro: int = 0
+    now: Optional[float] = 0
+    flight: Optional[str] = "N/A"
+    hex: Optional[str] = None
+    tail: Optional[str] = None
+    gs: Optional[float] = 0
+    track: float = 0.
+
+@dataclass
+class OldFlight:
+    flight_id: str
+    tail: str
+    firstloc: OldLocation
+    lastloc: OldLocation
+    bboxes_list: list = field(default_factory=list)
+    external_id: str = None
+    alt_list: list = field(default_factory=list)
+    inside_bboxes: list = field(default_factory=list)
+    threadlock: Lock = field(default_factory=Lock)
+    flags: dict = field(default_factory=lambda: ({}))
+
+    def __post_init__(self):
+        self.inside_bboxes = [-1] * len(self.bboxes_list)
+
+def messages(n_aircraft, n_updates, bboxes):
+    """readsb-like updates, as freshly decoded strings would arrive"""
+    bounds = [box.polygon.bounds for box in bboxes.boxes]
+    x0 = min(b[0] for b in bounds)
+    y0 = min(b[1] for b in bounds)
+    x1 = max(b[2] for b in bounds)
+    y1 = max(b[3] for b in bounds)
+    rand = random.Random(1)
+    aircraft = [[rand.uniform(y0, y1), rand.uniform(x0, x1), rand.randint(0, 6000),
+                 rand.uniform(60, 250), rand.uniform(0, 360)] for _ in range(n_aircraft)]
+    for step in range(n_updates):
+        for i, a in enumerate(aircraft):
+            lat, lon, alt, gs, track = a
+            d = gs / 3600. / 60.
+            a[0] = lat = lat + d * math.cos(math.radians(track))
+            a[1] = lon = lon + d * math.sin(math.radians(track)) / math.cos(math.radians(lat))
+            a[2] = alt = max(0, alt + rand.choice((-20, 0, 0, 20)))
+            yield ("N%dAB" % i, "a%05x" % i, lat, lon, alt, 1692547200. + step, gs, track)
+
+def old_track(n_aircraft, n_updates, bboxes_list):
+    flight_dict = {}
+    for flight_id, hexcode, lat, lon, alt, now, gs, track in messages(n_aircraft, n_updates,
+                                                                      bboxes_list[0]):
+        loc = OldLocation(lat, lon, alt, now, flight_id, hexcode, None, gs, track)
+        if flight_id in flight_dict:
+            flight_dict[flight_id].lastloc = loc
+        else:
+            flight_dict[flight_id] = OldFlight(flight_id, None, loc, loc, bboxes_list)
+    return flight_dict
+
+def new_track(n_aircraft, n_updates, bboxes_list, inplace, history=Flight.HISTORY_DEPTH):
+    flights = Flights(bboxes_list)
+    flights.INPLACE_LOCATIONS = inplace
+    Flight.HISTORY_DEPTH = history
+    last = None
+    for flight_id, hexcode, lat, lon, alt, now, gs, track in messages(n_aircraft, n_updates,
+                                                                      bboxes_list[0]):
+        loc = Location(lat, lon, alt, now, flight_id, hexcode, None, gs, track)
+        flights.add_location(loc, None, None, None)
+        if now != last:
+            flights.expire_old(None, now)
+            last = now
+    return flights
+
+def measure(name, fn, n_aircraft):
+    gc.collect()
+    tracemalloc.start()
+    result = fn()
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("%-28s %7.0f bytes/aircraft  peak %7.0f bytes/aircraft" %
+          (name, current / n_aircraft, peak / n_aircraft))
+    return result
+
+def main():
+    n_aircraft = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_updates = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    bboxes_list = [Bboxes(fn) for fn in (sys.argv[3:] or DEFAULT_KMLS)]
+    print("%d aircraft, %d updates each, %d KML layers, python %s" %
+          (n_aircraft, n_updates, len(bboxes_list), sys.version.split()[0]))
+    depth = Flight.HISTORY_DEPTH
+    measure("dict dataclasses", lambda: old_track(n_aircraft, n_updates, bboxes_list),
+            n_aircraft)
+    measure("slotted", lambda: new_track(n_aircraft, n_updates, bboxes_list, False), n_aircraft)
+    flights = measure("slotted, in place",
+                      lambda: new_track(n_aircraft, n_updates, bboxes_list, True), n_aircraft)
+    measure("slotted, in place, no history",
+            lambda: new_track(n_aircraft, n_updates, bboxes_list, True, 0), n_aircraft)
+    Flight.HISTORY_DEPTH = depth
+    with_history = sum(1 for flight in flights.flight_dict.values() if flight.history is not None)
+    print("%d of %d aircraft entered a box and kept a track history" %
+          (with_history, len(flights.flight_dict)))
+
+if __name__ == "__main__":
+    main()